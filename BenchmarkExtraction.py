@@ -0,0 +1,310 @@
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import shutil
+import atexit
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(REPO_DIR, "Logs", "benchmark_baseline.json")
+
+# FetchConfig creates Logs/Config and truncates Logs/collector.log on import,
+# so it is imported from a scratch directory to leave the working tree alone.
+# User paths are resolved against the directory the benchmark was started from.
+ORIGINAL_CWD = os.getcwd()
+SCRATCH_DIR = tempfile.mkdtemp(prefix="v2ray-bench-")
+atexit.register(shutil.rmtree, SCRATCH_DIR, ignore_errors=True)
+sys.path.insert(0, REPO_DIR)
+os.chdir(SCRATCH_DIR)
+import FetchConfig
+
+from telethon.tl.types import (
+    Message,
+    PeerChannel,
+    MessageEntityUrl,
+    MessageEntityTextUrl,
+    MessageMediaDocument,
+    Document,
+    DocumentAttributeFilename,
+)
+
+PERSIAN_WORDS = [
+    "سلام", "کانفیگ", "جدید", "رایگان", "پرسرعت", "اتصال", "سرور", "فیلترشکن",
+    "امروز", "برای", "همه", "اپراتورها", "تست", "شده", "کانال", "ما", "عضو", "شوید",
+]
+ENGLISH_WORDS = [
+    "free", "config", "fast", "server", "join", "channel", "new", "tested",
+    "working", "all", "operators", "today", "share", "with", "friends",
+]
+OPERATOR_TAGS = list(FetchConfig.OPERATORS.keys()) + ["#MCI", "#MTN", "#RighTel"]
+CHANNEL_REFERENCES = [
+    "@Alpha_V2ray_Iran", "https://t.me/Farah_VPN", "t.me/iMTProto/1234", "https://t.me/+AbCdEf123",
+    "joinchat/XyZ987", "-1001234567890", "c/1234567", "ZibaNabz", "https://t.me/vaddress/55",
+]
+PASSWORD_LINES = [
+    "پسورد: {password}", "رمز عبور : `{password}`", "password = '{password}'",
+    "Pass - {password}", "رمز\n{password}", "🔑 رمز: {password}",
+]
+
+
+def random_host(rng):
+    if rng.random() < 0.5:
+        return ".".join(str(rng.randint(1, 254)) for _ in range(4))
+    return f"{rng.choice(['cdn', 'sv', 'node', 'fast'])}{rng.randint(1, 999)}.{rng.choice(['example.com', 'ir-cdn.net', 'speed.org'])}"
+
+
+def random_uuid(rng):
+    return "-".join("".join(rng.choice("0123456789abcdef") for _ in range(n)) for n in (8, 4, 4, 4, 12))
+
+
+def make_vless(rng):
+    params = [f"type={rng.choice(['ws', 'grpc', 'tcp'])}", f"security={rng.choice(['tls', 'reality', 'none'])}",
+              f"sni={random_host(rng)}", "path=%2F" + rng.choice(["ws", "api", "live"]), "fp=chrome"]
+    rng.shuffle(params)
+    return f"vless://{random_uuid(rng)}@{random_host(rng)}:{rng.choice([443, 8443, 2053, 80])}?{'&'.join(params)}#{rng.choice(ENGLISH_WORDS)}-{rng.randint(1, 99)}"
+
+
+def make_vmess(rng):
+    data = {"v": "2", "ps": rng.choice(PERSIAN_WORDS), "add": random_host(rng), "port": str(rng.choice([443, 80, 8080])),
+            "id": random_uuid(rng), "aid": "0", "net": rng.choice(["ws", "tcp"]), "type": "none",
+            "host": random_host(rng), "path": "/", "tls": rng.choice(["tls", ""])}
+    return "vmess://" + base64.b64encode(json.dumps(data, ensure_ascii=False).encode("utf-8")).decode("ascii")
+
+
+def make_shadowsocks(rng):
+    userinfo = base64.b64encode(f"chacha20-ietf-poly1305:{random_uuid(rng)[:12]}".encode("ascii")).decode("ascii")
+    return f"ss://{userinfo}@{random_host(rng)}:{rng.randint(1000, 65000)}#{rng.choice(ENGLISH_WORDS)}"
+
+
+def make_trojan(rng):
+    return f"trojan://{random_uuid(rng)}@{random_host(rng)}:443?security=tls&sni={random_host(rng)}&type=tcp#{rng.choice(PERSIAN_WORDS)}"
+
+
+def make_proxy(rng):
+    secret = "ee" + "".join(rng.choice("0123456789abcdef") for _ in range(32))
+    return f"https://t.me/proxy?server={random_host(rng)}&port={rng.choice([443, 8443, 88])}&secret={secret}"
+
+
+CONFIG_MAKERS = [make_vless, make_vless, make_vless, make_shadowsocks, make_shadowsocks, make_trojan, make_vmess]
+
+
+def random_sentence(rng, words=None):
+    words = words or (PERSIAN_WORDS if rng.random() < 0.7 else ENGLISH_WORDS)
+    return " ".join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+
+
+def build_message(message_id, text, entities=None, npvt_name=None):
+    media = None
+    if npvt_name:
+        media = MessageMediaDocument(document=Document(
+            id=message_id, access_hash=message_id * 7, file_reference=b"", date=None,
+            mime_type="application/octet-stream", size=2048, dc_id=4,
+            attributes=[DocumentAttributeFilename(npvt_name)]
+        ))
+    return Message(
+        id=message_id,
+        peer_id=PeerChannel(1),
+        date=datetime(2026, 1, 1, tzinfo=timezone.utc),
+        message=text,
+        entities=entities,
+        media=media
+    )
+
+
+def generate_message(rng, message_id):
+    lines = [random_sentence(rng)]
+    entities = []
+    npvt_name = None
+    kind = rng.random()
+
+    if kind < 0.45:
+        for _ in range(rng.randint(1, 6)):
+            lines.append(rng.choice(CONFIG_MAKERS)(rng))
+    elif kind < 0.65:
+        for _ in range(rng.randint(1, 8)):
+            label = f"Proxy {len(entities) + 1}"
+            offset = len("\n".join(lines)) + 1
+            lines.append(label)
+            entities.append(MessageEntityTextUrl(offset, len(label), make_proxy(rng)))
+        if rng.random() < 0.5:
+            lines.append(make_proxy(rng))
+    elif kind < 0.8:
+        npvt_name = f"{rng.choice(ENGLISH_WORDS)}_{rng.randint(1, 999)}.npvt"
+        lines.append(rng.choice(PASSWORD_LINES).format(password=random_uuid(rng)[:rng.randint(4, 12)]))
+    else:
+        lines.append(random_sentence(rng))
+
+    if rng.random() < 0.4:
+        lines.append(" ".join(rng.sample(OPERATOR_TAGS, rng.randint(1, 3))))
+    if rng.random() < 0.3:
+        reference = rng.choice(CHANNEL_REFERENCES)
+        offset = len("\n".join(lines)) + 1
+        lines.append(reference)
+        entities.append(MessageEntityUrl(offset, len(reference)))
+
+    return build_message(message_id, "\n".join(lines), entities or None, npvt_name)
+
+
+def generate_pathological_messages(rng, start_id):
+    messages = []
+    huge_text = "\n".join(random_sentence(rng) for _ in range(4000))
+    messages.append(build_message(start_id, huge_text))
+    huge_configs = "\n".join(rng.choice(CONFIG_MAKERS)(rng) for _ in range(1500))
+    messages.append(build_message(start_id + 1, huge_configs))
+    messages.append(build_message(start_id + 2, "x" * 200000 + " vless://" + "a" * 50000))
+
+    lines = []
+    entities = []
+    for i in range(600):
+        label = f"P{i}"
+        offset = len(" ".join(lines)) + (1 if lines else 0)
+        lines.append(label)
+        entities.append(MessageEntityTextUrl(offset, len(label), make_proxy(rng)))
+    messages.append(build_message(start_id + 3, " ".join(lines), entities))
+    return messages
+
+
+def generate_corpus(seed=1, count=5000, pathological=True):
+    rng = random.Random(seed)
+    messages = [generate_message(rng, i + 1) for i in range(count)]
+    if pathological:
+        messages.extend(generate_pathological_messages(rng, count + 1))
+    return messages
+
+
+def legacy_config_matching(text):
+    return [re.findall(pattern, text) for pattern in FetchConfig.CONFIG_PATTERNS.values()]
+
+
+def build_cases(messages):
+    texts = [message.message or "" for message in messages]
+    configs = []
+    for text in texts:
+        for protocol, matches in FetchConfig.extract_links_from_text(text)[0].items():
+            configs.extend((config, protocol) for config in matches)
+    channel_references = CHANNEL_REFERENCES * max(1, len(messages) // len(CHANNEL_REFERENCES))
+
+    def clear_parse_cache():
+        FetchConfig.parse_config_record.cache_clear()
+
+    return {
+        "config_patterns": (texts, legacy_config_matching, None),
+        "extract_links_from_text": (texts, FetchConfig.extract_links_from_text, None),
+        "extract_message": (messages, FetchConfig.extract_message, None),
+        "extract_proxies_from_message": (messages, FetchConfig.extract_proxies_from_message, None),
+        "detect_operator": (texts, FetchConfig.detect_operator, None),
+        "extract_npvt_password": (texts, FetchConfig.extract_npvt_password, None),
+        "extract_npvt_filename": (messages, FetchConfig.extract_npvt_filename, None),
+        "extract_server_address": (configs, lambda item: FetchConfig.extract_server_address(*item), clear_parse_cache),
+        "parse_channel_identifier": (channel_references, FetchConfig.parse_channel_identifier, None),
+    }
+
+
+def run_case(items, func, setup, repeat):
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    baseline_bytes, _ = tracemalloc.get_traced_memory()
+    for item in items:
+        func(item)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    # Memory still held after the run (caches, interned strings), attributed per item
+    ignore_tracemalloc = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(ignore_tracemalloc).compare_to(before.filter_traces(ignore_tracemalloc), "filename")
+    count = max(1, len(items))
+    return {
+        "items": len(items),
+        "seconds": round(best, 6),
+        "items_per_sec": round(len(items) / best, 1) if best else None,
+        "alloc_bytes_per_item": round(sum(stat.size_diff for stat in stats) / count, 1),
+        "allocs_per_item": round(sum(stat.count_diff for stat in stats) / count, 3),
+        "peak_bytes": peak - baseline_bytes,
+    }
+
+
+def compare_with_baseline(results, baseline, threshold):
+    regressions = []
+    print(f"\n{'function':32} {'baseline/s':>14} {'current/s':>14} {'change':>9}")
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous or not previous.get("items_per_sec") or not result["items_per_sec"]:
+            print(f"{name:32} {'-':>14} {result['items_per_sec']:>14} {'new':>9}")
+            continue
+        change = (result["items_per_sec"] - previous["items_per_sec"]) / previous["items_per_sec"] * 100
+        marker = ""
+        if change < -threshold:
+            marker = " ❌"
+            regressions.append(name)
+        print(f"{name:32} {previous['items_per_sec']:>14} {result['items_per_sec']:>14} {change:>+8.1f}%{marker}")
+    return regressions
+
+
+def user_path(path):
+    return os.path.abspath(os.path.join(ORIGINAL_CWD, path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the message extraction hot paths")
+    parser.add_argument("--messages", type=int, default=5000, help="number of synthetic messages")
+    parser.add_argument("--seed", type=int, default=1, help="corpus seed")
+    parser.add_argument("--repeat", type=int, default=5, help="timed repetitions, best one is reported")
+    parser.add_argument("--only", action="append", help="run only the named function (repeatable)")
+    parser.add_argument("--no-pathological", action="store_true", help="skip huge/entity-heavy messages")
+    parser.add_argument("--save-baseline", nargs="?", const=BASELINE_FILE, type=user_path, help="write results as the new baseline")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_FILE, type=user_path, help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown in percent when comparing")
+    args = parser.parse_args()
+
+    messages = generate_corpus(args.seed, args.messages, not args.no_pathological)
+    print(f"Generated {len(messages)} synthetic messages (seed {args.seed})\n")
+    print(f"{'function':32} {'items':>8} {'items/s':>14} {'alloc B/item':>12} {'allocs/item':>12} {'peak KiB':>10}")
+
+    results = {}
+    for name, (items, func, setup) in build_cases(messages).items():
+        if args.only and name not in args.only:
+            continue
+        result = run_case(items, func, setup, args.repeat)
+        results[name] = result
+        print(f"{name:32} {result['items']:>8} {result['items_per_sec']:>14} {result['alloc_bytes_per_item']:>12} {result['allocs_per_item']:>12} {result['peak_bytes'] / 1024:>10.1f}")
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ Slower than baseline by more than {args.threshold}%: {', '.join(regressions)}")
+            exit_code = 1
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"seed": args.seed, "messages": len(messages), "results": results}, f, ensure_ascii=False, indent=4)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,31 +5,143 @@ import logging
 import random
 import base64
 import asyncio
-from datetime import datetime, timedelta
+import hashlib
+import gzip
+import ssl
+import time
+import math
+import bisect
+import contextlib
+import sys
+import sqlite3
+import socket
+import ipaddress
+import mmap
+import struct
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from urllib.parse import urlsplit, unquote, parse_qsl
+from telethon import events, utils
 from telethon.sync import TelegramClient
-from telethon.tl.types import Message, MessageEntityTextUrl, MessageEntityUrl
+from telethon.tl.types import Message, MessageEntityTextUrl, MessageEntityUrl, MessageEntityMention, InputPeerChannel, InputPeerChat, InputPeerUser, MessageMediaDocument, Document, DocumentAttributeFilename
 from telethon.tl.functions.messages import CheckChatInviteRequest, ImportChatInviteRequest
 from telethon.sessions import StringSession
-from telethon.errors import ChannelInvalidError, PeerIdInvalidError
-from collections import defaultdict
+from telethon.errors import ChannelInvalidError, PeerIdInvalidError, FloodWaitError, UnauthorizedError
+from collections import defaultdict, namedtuple, OrderedDict
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
 
 SESSION_STRING = os.getenv("TELEGRAM_SESSION_STRING", None)
 API_ID = os.getenv("TELEGRAM_API_ID", None)
 API_HASH = os.getenv("TELEGRAM_API_HASH", None)
+# Extra accounts: comma or newline separated, API credentials default to the ones above
+SESSION_STRINGS = [value.strip() for value in re.split(r"[,\n]", os.getenv("TELEGRAM_SESSION_STRINGS", "")) if value.strip()]
+API_IDS = [value.strip() for value in re.split(r"[,\n]", os.getenv("TELEGRAM_API_IDS", "")) if value.strip()]
+API_HASHES = [value.strip() for value in re.split(r"[,\n]", os.getenv("TELEGRAM_API_HASHES", "")) if value.strip()]
+ACCOUNT_RING_REPLICAS = 64
 CHANNELS_FILE = "telegram_channels.json"
 LOG_DIR = "Logs"
 OUTPUT_DIR = "Config"
 NPVT_DIR = os.path.join(OUTPUT_DIR, "npvt")
+NPVT_INDEX_FILE = os.path.join(NPVT_DIR, "index.json")
+GEO_DIR = os.path.join(OUTPUT_DIR, "geo")
+ASN_DIR = os.path.join(OUTPUT_DIR, "asn")
 INVALID_CHANNELS_FILE = os.path.join(LOG_DIR, "invalid_channels.txt")
 STATS_FILE = os.path.join(LOG_DIR, "channel_stats.json")
+CURSORS_FILE = os.path.join(LOG_DIR, "channel_cursors.json")
+CHANNEL_HISTORY_FILE = os.path.join(LOG_DIR, "channel_history.json")
+DISCOVERY_SEEN_FILE = os.path.join(LOG_DIR, "discovery_seen.bloom")
+DISCOVERY_CANDIDATES_FILE = os.path.join(LOG_DIR, "discovery_candidates.json")
+SEEN_INDEX_FILE = os.path.join(LOG_DIR, "seen_index.bin")
+PROBE_CACHE_FILE = os.path.join(LOG_DIR, "probe_cache.json")
+DNS_CACHE_FILE = os.path.join(LOG_DIR, "dns_cache.json")
+OUTPUT_MANIFEST_FILE = os.path.join(LOG_DIR, "output_manifest.json")
+ENTITY_CACHE_FILE = os.path.join(LOG_DIR, "entity_cache.json")
+METRICS_JSON_FILE = os.path.join(LOG_DIR, "metrics.json")
+METRICS_PROM_FILE = os.path.join(LOG_DIR, "metrics.prom")
+MESSAGE_ARCHIVE_DIR = os.path.join(LOG_DIR, "archive")
+CONFIG_STORE_FILE = os.path.join(LOG_DIR, "config_store.db")
 DESTINATION_CHANNEL = "@V2RayRootFree"
+MAX_CONCURRENT_CHANNELS = int(os.getenv("MAX_CONCURRENT_CHANNELS", "4"))
+# Bounds the raw records each channel cursor carries between runs
+CURSOR_MAX_RECORDS = int(os.getenv("CURSOR_MAX_RECORDS", "500"))
+POLL_TARGET_ITEMS = float(os.getenv("POLL_TARGET_ITEMS", "5"))
+POLL_MIN_INTERVAL = int(os.getenv("POLL_MIN_INTERVAL", "0"))
+POLL_MAX_INTERVAL = int(os.getenv("POLL_MAX_INTERVAL", str(12 * 3600)))
+POLL_EWMA_ALPHA = float(os.getenv("POLL_EWMA_ALPHA", "0.3"))
+POLL_FAILURE_BACKOFF = int(os.getenv("POLL_FAILURE_BACKOFF", "1800"))
+POLL_MAX_BACKOFF = int(os.getenv("POLL_MAX_BACKOFF", str(7 * 24 * 3600)))
+POLL_QUARANTINE_AFTER = int(os.getenv("POLL_QUARANTINE_AFTER", "3"))
+DISCOVERY_ENABLED = os.getenv("DISCOVERY_ENABLED", "1") == "1"
+DISCOVERY_PROBES_PER_RUN = int(os.getenv("DISCOVERY_PROBES_PER_RUN", "5"))
+DISCOVERY_PROBE_MESSAGES = int(os.getenv("DISCOVERY_PROBE_MESSAGES", "100"))
+DISCOVERY_MIN_CONFIGS = int(os.getenv("DISCOVERY_MIN_CONFIGS", "10"))
+DISCOVERY_MAX_PENDING = int(os.getenv("DISCOVERY_MAX_PENDING", "1000"))
+# Only a handful of candidates are probed per run, so a few thousand a year; about 36 KB at 0.1%
+DISCOVERY_SEEN_CAPACITY = int(os.getenv("DISCOVERY_SEEN_CAPACITY", "20000"))
+DISCOVERY_SEEN_ERROR_RATE = float(os.getenv("DISCOVERY_SEEN_ERROR_RATE", "0.001"))
+PROBE_ENABLED = os.getenv("PROBE_ENABLED", "1") == "1"
+PROBE_TLS = os.getenv("PROBE_TLS", "0") == "1"
+PROBE_DROP_UNREACHABLE = os.getenv("PROBE_DROP_UNREACHABLE", "0") == "1"
+PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", "500"))
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "3"))
+PROBE_CACHE_TTL = int(os.getenv("PROBE_CACHE_TTL", "21600"))
+PROBE_NEGATIVE_TTL = int(os.getenv("PROBE_NEGATIVE_TTL", "600"))
+PROXY_DROP_UNREACHABLE = os.getenv("PROXY_DROP_UNREACHABLE", "0") == "1"
+NPVT_CACHE_MAX_BYTES = int(os.getenv("NPVT_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+NPVT_CACHE_MAX_AGE = int(os.getenv("NPVT_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+NPVT_DOWNLOAD_WORKERS = int(os.getenv("NPVT_DOWNLOAD_WORKERS", "4"))
+NPVT_QUEUE_SIZE = int(os.getenv("NPVT_QUEUE_SIZE", "32"))
+NPVT_DOWNLOAD_TIMEOUT = float(os.getenv("NPVT_DOWNLOAD_TIMEOUT", "120"))
+TELEGRAM_REQUEST_RATE = float(os.getenv("TELEGRAM_REQUEST_RATE", "10"))
+TELEGRAM_REQUEST_BURST = int(os.getenv("TELEGRAM_REQUEST_BURST", "20"))
+TELEGRAM_FLOOD_RETRIES = int(os.getenv("TELEGRAM_FLOOD_RETRIES", "3"))
+TELEGRAM_MAX_FLOOD_WAIT = int(os.getenv("TELEGRAM_MAX_FLOOD_WAIT", "300"))
+# Telegram returns at most 100 messages per history request
+HISTORY_PAGE_SIZE = 100
+POST_INTERVAL = float(os.getenv("POST_INTERVAL", "4"))
+POST_AS_ALBUM = os.getenv("POST_AS_ALBUM", "0") == "1"
+ALBUM_MAX_ITEMS = 10
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+MESSAGE_ARCHIVE_ENABLED = os.getenv("MESSAGE_ARCHIVE_ENABLED", "1") == "1"
+# Archive files are kept per day; 0 keeps every day
+MESSAGE_ARCHIVE_RETENTION_DAYS = int(os.getenv("MESSAGE_ARCHIVE_RETENTION_DAYS", "14"))
+SEEN_INDEX_ENABLED = os.getenv("SEEN_INDEX_ENABLED", "1") == "1"
+SEEN_INDEX_MAX_AGE = int(os.getenv("SEEN_INDEX_MAX_AGE", str(3 * 86400)))
+SEEN_INDEX_REFRESH = int(os.getenv("SEEN_INDEX_REFRESH", "86400"))
+SEEN_INDEX_MIN_SLOTS = 1 << 16
+CONFIG_STORE_ENABLED = os.getenv("CONFIG_STORE_ENABLED", "1") == "1"
+CONFIG_STORE_TTL = int(os.getenv("CONFIG_STORE_TTL", "86400"))
+CONFIG_STORE_RETENTION = int(os.getenv("CONFIG_STORE_RETENTION", str(30 * 24 * 3600)))
+GEOIP_ENABLED = os.getenv("GEOIP_ENABLED", "1") == "1"
+GEOIP_COUNTRY_DB = os.getenv("GEOIP_COUNTRY_DB", os.path.join("GeoIP", "GeoLite2-Country.mmdb"))
+GEOIP_ASN_DB = os.getenv("GEOIP_ASN_DB", os.path.join("GeoIP", "GeoLite2-ASN.mmdb"))
+DNS_CONCURRENCY = int(os.getenv("DNS_CONCURRENCY", "200"))
+DNS_TIMEOUT = float(os.getenv("DNS_TIMEOUT", "3"))
+DNS_CACHE_TTL = int(os.getenv("DNS_CACHE_TTL", "3600"))
+DNS_NEGATIVE_TTL = int(os.getenv("DNS_NEGATIVE_TTL", "600"))
+REPLAY_MODE = "--replay" in sys.argv[1:]
+REPLAY_OUTPUT_DIR = os.getenv("REPLAY_OUTPUT_DIR", os.path.join(LOG_DIR, "replay"))
+DAEMON_MODE = "--daemon" in sys.argv[1:] or os.getenv("DAEMON_MODE", "0") == "1"
+DAEMON_FLUSH_DELAY = float(os.getenv("DAEMON_FLUSH_DELAY", "30"))
+DAEMON_FLUSH_MAX_DELAY = float(os.getenv("DAEMON_FLUSH_MAX_DELAY", "300"))
+DAEMON_POST_INTERVAL = float(os.getenv("DAEMON_POST_INTERVAL", "3600"))
+SERVER_PORT = int(os.getenv("SERVER_PORT", "0"))
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_IDLE_TIMEOUT = float(os.getenv("SERVER_IDLE_TIMEOUT", "15"))
+SERVER_QUERY_CACHE_SIZE = 256
 CONFIG_PATTERNS = {
     "vless": r"vless://[^\s\n]+",
     "vmess": r"vmess://[^\s\n]+",
     "shadowsocks": r"ss://[^\s\n]+",
     "trojan": r"trojan://[^\s\n]+"
 }
-PROXY_PATTERN = r"https:\/\/t\.me\/proxy\?server=[^&\s\)]+&port=\d+&secret=[^\s\)]+"
+# Parameters may come in any order; links without a server, port and secret are dropped by parse_proxy_link()
+PROXY_PATTERN = r"(?:https?:\/\/(?:t|telegram)\.me\/proxy|tg:\/\/proxy)\?[^\s\)]+"
+PROXY_LINK_PREFIXES = ("https://t.me/proxy?", "http://t.me/proxy?", "https://telegram.me/proxy?", "http://telegram.me/proxy?", "tg://proxy?")
 
 OPERATORS = {
     "همراه اول": "HamrahAval",
@@ -46,6 +158,38 @@ OPERATORS = {
     "#شاتل": "Shatel",
 }
 
+CONFIG_REGEXES = {protocol: re.compile(pattern) for protocol, pattern in CONFIG_PATTERNS.items()}
+PROXY_REGEX = re.compile(PROXY_PATTERN)
+WHITESPACE_REGEX = re.compile(r"\s")
+HEX_SECRET_REGEX = re.compile(r"(?:[0-9a-fA-F]{2}){16,}")
+NPVT_PASSWORD_REGEXES = [
+    re.compile(r"(?:رمز\s*عبور|رمز|پسورد|password|pass)\s*[:=\-]\s*[`'\"]?([^\s\n`'\"]+)[`'\"]?", re.IGNORECASE),
+    re.compile(r"(?:رمز\s*عبور|رمز|پسورد|password|pass)\s*\n+\s*([^\s\n`'\"]+)", re.IGNORECASE)
+]
+CONFIG_SCHEMES = {
+    "vless://": "vless",
+    "vmess://": "vmess",
+    "ss://": "shadowsocks",
+    "trojan://": "trojan"
+}
+VMESS_IGNORED_KEYS = {"ps", "v"}
+
+ConfigRecord = namedtuple(
+    "ConfigRecord",
+    ["protocol", "host", "port", "credential", "transport", "security", "params", "fingerprint"]
+)
+TimelineItem = namedtuple("TimelineItem", ["protocol", "config", "source"])
+ProxyItem = namedtuple("ProxyItem", ["proxy", "source"])
+ProxyRecord = namedtuple("ProxyRecord", ["server", "port", "secret"])
+
+NPVT_PASSWORD_CHARSET_REGEX = re.compile(r'[a-zA-Z0-9!@#$%^&*_\-+=.]+')
+CHANNEL_LINK_REGEX = re.compile(r"(?:https?://)?(?:t|telegram)\.me/(?:s/)?([A-Za-z0-9_+]+)", re.IGNORECASE)
+CHANNEL_USERNAME_REGEX = re.compile(r"@[A-Za-z][A-Za-z0-9_]{4,31}")
+RESERVED_TME_PATHS = {
+    "proxy", "socks", "joinchat", "addstickers", "addemoji", "addtheme", "addlist",
+    "share", "iv", "login", "setlanguage", "bg", "confirmphone", "boost", "contact"
+}
+
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
@@ -57,6 +201,216 @@ file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(mes
 file_handler.setLevel(logging.DEBUG)
 logger.addHandler(file_handler)
 
+class StageTimer:
+    def __init__(self, metrics, stage, channel):
+        self.metrics = metrics
+        self.stage = stage
+        self.channel = channel
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started, self.channel)
+        return False
+
+# Per-stage wall time and byte counts for one run. Stages are aggregated per
+# channel, and run percentiles are taken over the per-channel totals. When
+# disabled, timed() hands out a shared no-op context.
+class RunMetrics:
+    NULL_TIMER = contextlib.nullcontext()
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.time()
+        self.seconds = defaultdict(lambda: defaultdict(float))
+        self.bytes = defaultdict(lambda: defaultdict(int))
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def timed(self, stage, channel=None):
+        if not self.enabled:
+            return self.NULL_TIMER
+        return StageTimer(self, stage, channel)
+
+    def observe(self, stage, seconds, channel=None):
+        self.seconds[stage][channel] += seconds
+        self.counts[stage][channel] += 1
+
+    def add_bytes(self, stage, size, channel=None):
+        if self.enabled:
+            self.bytes[stage][channel] += size
+
+    def summary(self):
+        stages = {}
+        for stage in sorted(set(self.seconds) | set(self.bytes)):
+            per_channel = sorted(value for channel, value in self.seconds[stage].items() if channel is not None)
+            stages[stage] = {
+                "count": sum(self.counts[stage].values()),
+                "total_seconds": round(sum(self.seconds[stage].values()), 6),
+                "bytes": sum(self.bytes[stage].values()),
+                "channel_count": len(per_channel),
+                "channel_total_seconds": round(sum(per_channel), 6),
+                "channel_p50_seconds": round(percentile(per_channel, 50), 6),
+                "channel_p90_seconds": round(percentile(per_channel, 90), 6),
+                "channel_p99_seconds": round(percentile(per_channel, 99), 6),
+                "channel_max_seconds": round(per_channel[-1], 6) if per_channel else 0,
+            }
+
+        channels = defaultdict(dict)
+        for stage, values in self.seconds.items():
+            for channel, seconds in values.items():
+                if channel is not None:
+                    channels[str(channel)][f"{stage}_seconds"] = round(seconds, 6)
+        for stage, values in self.bytes.items():
+            for channel, size in values.items():
+                if channel is not None:
+                    channels[str(channel)][f"{stage}_bytes"] = size
+
+        return {
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+            "duration_seconds": round(time.time() - self.started_at, 3),
+            "stages": stages,
+            "channels": dict(sorted(channels.items())),
+        }
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def render_prometheus_metrics(summary):
+    lines = [
+        "# HELP v2ray_collector_run_duration_seconds Wall time of the last collection run.",
+        "# TYPE v2ray_collector_run_duration_seconds gauge",
+        f"v2ray_collector_run_duration_seconds {summary['duration_seconds']}",
+        "# HELP v2ray_collector_stage_seconds Per-channel stage time of the last run.",
+        "# TYPE v2ray_collector_stage_seconds summary",
+    ]
+    # Quantiles, sum and count all describe the per-channel totals; run-level time is in the gauges below
+    for stage, data in summary["stages"].items():
+        for quantile, pct in (("0.5", "50"), ("0.9", "90"), ("0.99", "99")):
+            lines.append(f'v2ray_collector_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {data[f"channel_p{pct}_seconds"]}')
+        lines.append(f'v2ray_collector_stage_seconds_sum{{stage="{stage}"}} {data["channel_total_seconds"]}')
+        lines.append(f'v2ray_collector_stage_seconds_count{{stage="{stage}"}} {data["channel_count"]}')
+    lines += [
+        "# HELP v2ray_collector_stage_total_seconds Time spent in each stage in the last run, including run-level work.",
+        "# TYPE v2ray_collector_stage_total_seconds gauge",
+    ]
+    for stage, data in summary["stages"].items():
+        lines.append(f'v2ray_collector_stage_total_seconds{{stage="{stage}"}} {data["total_seconds"]}')
+    lines += [
+        "# HELP v2ray_collector_stage_calls Timed calls of each stage in the last run.",
+        "# TYPE v2ray_collector_stage_calls gauge",
+    ]
+    for stage, data in summary["stages"].items():
+        lines.append(f'v2ray_collector_stage_calls{{stage="{stage}"}} {data["count"]}')
+    lines += [
+        "# HELP v2ray_collector_stage_bytes Bytes handled by each stage in the last run.",
+        "# TYPE v2ray_collector_stage_bytes gauge",
+    ]
+    for stage, data in summary["stages"].items():
+        lines.append(f'v2ray_collector_stage_bytes{{stage="{stage}"}} {data["bytes"]}')
+    for unit, description in (("seconds", "Stage time"), ("bytes", "Stage bytes")):
+        lines += [
+            f"# HELP v2ray_collector_channel_stage_{unit} {description} per channel in the last run.",
+            f"# TYPE v2ray_collector_channel_stage_{unit} gauge",
+        ]
+        for channel, data in summary["channels"].items():
+            for key, value in data.items():
+                stage, _, key_unit = key.rpartition("_")
+                if key_unit == unit:
+                    lines.append(f'v2ray_collector_channel_stage_{unit}{{channel="{prometheus_label(channel)}",stage="{stage}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def save_run_metrics(metrics):
+    if not metrics.enabled:
+        return
+    summary = metrics.summary()
+    write_file_atomic(METRICS_JSON_FILE, json.dumps(summary, ensure_ascii=False, indent=4).encode("utf-8"))
+    write_file_atomic(METRICS_PROM_FILE, render_prometheus_metrics(summary).encode("utf-8"))
+    logger.info(f"Saved run metrics to {METRICS_JSON_FILE} and {METRICS_PROM_FILE}")
+
+run_metrics = RunMetrics()
+
+# Request classes ("resolve", "history", "download", "send") share one token
+# bucket, but a FloodWaitError only pauses the class that caused it.
+class RequestScheduler:
+    def __init__(self, rate, burst, max_retries=TELEGRAM_FLOOD_RETRIES, max_flood_wait=TELEGRAM_MAX_FLOOD_WAIT, min_intervals=None):
+        self.rate = max(rate, 0.001)
+        self.burst = max(burst, 1)
+        self.max_retries = max_retries
+        self.max_flood_wait = max_flood_wait
+        self.min_intervals = min_intervals or {}
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = defaultdict(float)
+        self.next_allowed = defaultdict(float)
+        self.flood_waits = defaultdict(int)
+
+    async def acquire(self, request_class):
+        interval = self.min_intervals.get(request_class, 0)
+        if interval:
+            now = time.monotonic()
+            slot = max(now, self.next_allowed[request_class])
+            self.next_allowed[request_class] = slot + interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+
+        while True:
+            now = time.monotonic()
+            pause = self.paused_until[request_class] - now
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, request_class, seconds):
+        self.flood_waits[request_class] += 1
+        self.paused_until[request_class] = max(self.paused_until[request_class], time.monotonic() + seconds)
+
+    async def call(self, request_class, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            await self.acquire(request_class)
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                attempt += 1
+                if attempt > self.max_retries or e.seconds > self.max_flood_wait:
+                    logger.error(f"Flood wait of {e.seconds}s on {request_class} requests, giving up after {attempt} attempts")
+                    raise
+                logger.warning(f"Flood wait of {e.seconds}s on {request_class} requests, retry {attempt}/{self.max_retries}")
+                print(f"⏳ Telegram asked to wait {e.seconds}s for {request_class} requests")
+                self.pause(request_class, e.seconds + 1)
+
+telegram_scheduler = RequestScheduler(
+    TELEGRAM_REQUEST_RATE,
+    TELEGRAM_REQUEST_BURST,
+    min_intervals={"send": POST_INTERVAL}
+)
+
+# Rate limits and flood waits are per account, so each pooled client carries
+# its own scheduler; a single-account run keeps using telegram_scheduler.
+def client_scheduler(client):
+    return getattr(client, "scheduler", None) or telegram_scheduler
+
+def client_account_label(client):
+    return getattr(client, "account_label", None)
+
 def load_channels():
     with open(CHANNELS_FILE, "r", encoding="utf-8") as f:
         channels = json.load(f)
@@ -68,6 +422,84 @@ def update_channels(channels):
         json.dump(channels, f, ensure_ascii=False, indent=4)
     logger.info(f"Updated {CHANNELS_FILE} with {len(channels)} channels")
 
+def load_channel_cursors():
+    if not os.path.exists(CURSORS_FILE):
+        return {}
+    try:
+        with open(CURSORS_FILE, "r", encoding="utf-8") as f:
+            cursors = json.load(f)
+        logger.info(f"Loaded {len(cursors)} channel cursors from {CURSORS_FILE}")
+        return cursors
+    except Exception as e:
+        logger.error(f"Failed to load channel cursors from {CURSORS_FILE}: {str(e)}")
+        return {}
+
+def save_channel_cursors(cursors):
+    write_output_file(CURSORS_FILE, json.dumps(cursors, ensure_ascii=False, indent=4))
+    logger.info(f"Saved {len(cursors)} channel cursors to {CURSORS_FILE}")
+
+def load_channel_history():
+    if not os.path.exists(CHANNEL_HISTORY_FILE):
+        return {}
+    try:
+        with open(CHANNEL_HISTORY_FILE, "r", encoding="utf-8") as f:
+            history = json.load(f)
+        logger.info(f"Loaded polling history for {len(history)} channels from {CHANNEL_HISTORY_FILE}")
+        return history
+    except Exception as e:
+        logger.error(f"Failed to load channel history from {CHANNEL_HISTORY_FILE}: {str(e)}")
+        return {}
+
+def save_channel_history(history):
+    write_output_file(CHANNEL_HISTORY_FILE, json.dumps(history, ensure_ascii=False, indent=4))
+    logger.info(f"Saved polling history for {len(history)} channels to {CHANNEL_HISTORY_FILE}")
+
+def select_due_channels(channels, history, now=None):
+    if now is None:
+        now = time.time()
+    due = [ch for ch in channels if history.get(str(ch), {}).get("next_poll", 0) <= now]
+    # Productive channels are started first, so they get the API budget before slow ones
+    return sorted(due, key=lambda ch: -history.get(str(ch), {}).get("ewma_yield", float("inf")))
+
+def record_channel_success(history, channel, new_items, now=None):
+    if now is None:
+        now = time.time()
+    entry = history.setdefault(str(channel), {})
+    # A first poll covers the whole fetch window, roughly one day
+    hours = max((now - entry["last_polled"]) / 3600, 1 / 60) if entry.get("last_polled") else 24
+    rate = new_items / hours
+    if "ewma_yield" in entry:
+        entry["ewma_yield"] = round(POLL_EWMA_ALPHA * rate + (1 - POLL_EWMA_ALPHA) * entry["ewma_yield"], 4)
+    else:
+        entry["ewma_yield"] = round(rate, 4)
+    if new_items:
+        entry["last_new_content"] = now
+    entry["last_polled"] = now
+    entry["consecutive_failures"] = 0
+    entry["status"] = "active"
+
+    # Poll again once about POLL_TARGET_ITEMS new items are expected
+    interval = POLL_TARGET_ITEMS / entry["ewma_yield"] * 3600 if entry["ewma_yield"] > 0 else POLL_MAX_INTERVAL
+    entry["next_poll"] = now + min(max(interval, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+
+def record_channel_failure(history, channel, now=None):
+    if now is None:
+        now = time.time()
+    entry = history.setdefault(str(channel), {})
+    failures = entry.get("consecutive_failures", 0) + 1
+    entry["consecutive_failures"] = failures
+    entry["last_polled"] = now
+    entry["status"] = "quarantined" if failures >= POLL_QUARANTINE_AFTER else "failing"
+    entry["next_poll"] = now + min(POLL_FAILURE_BACKOFF * 2 ** (failures - 1), POLL_MAX_BACKOFF)
+    if failures == POLL_QUARANTINE_AFTER:
+        logger.warning(f"Channel {channel} quarantined after {failures} consecutive failures")
+
+def record_channel_throttled(history, channel, seconds, now=None):
+    if now is None:
+        now = time.time()
+    entry = history.setdefault(str(channel), {})
+    entry["next_poll"] = now + seconds
+
 if not os.path.exists(OUTPUT_DIR):
     logger.info(f"Creating directory: {OUTPUT_DIR}")
     os.makedirs(OUTPUT_DIR)
@@ -76,30 +508,219 @@ if not os.path.exists(NPVT_DIR):
     logger.info(f"Creating directory: {NPVT_DIR}")
     os.makedirs(NPVT_DIR)
 
-def extract_server_address(config, protocol):
+def decode_base64_text(data):
+    data = unquote(data).strip()
+    data += "=" * (-len(data) % 4)
+    if "-" in data or "_" in data:
+        return base64.urlsafe_b64decode(data).decode("utf-8")
+    return base64.b64decode(data).decode("utf-8")
+
+def detect_config_protocol(config):
+    for scheme, protocol in CONFIG_SCHEMES.items():
+        if config.startswith(scheme):
+            return protocol
+    return None
+
+def make_config_record(protocol, host, port, credential, params):
+    host = unquote(host).strip("[]").lower()
+    port = int(port)
+    if not host or not 0 < port < 65536:
+        raise ValueError(f"invalid endpoint {host}:{port}")
+
+    params = tuple(sorted((key.lower(), str(value)) for key, value in params if str(value) != ""))
+    param_map = dict(params)
+    if protocol == "vmess":
+        transport = param_map.get("net", "tcp")
+        security = param_map.get("tls", "none")
+    else:
+        transport = param_map.get("type", "tcp")
+        security = param_map.get("security", "tls" if protocol == "trojan" else "none")
+
+    canonical = "\n".join([protocol, host, str(port), credential] + [f"{key}={value}" for key, value in params])
+    fingerprint = hashlib.blake2b(canonical.encode("utf-8"), digest_size=8).hexdigest()
+    return ConfigRecord(protocol, host, port, credential, transport, security, params, fingerprint)
+
+def parse_url_config(protocol, config):
+    parts = urlsplit(config)
+    userinfo, _, hostport = parts.netloc.rpartition("@")
+    credential = unquote(userinfo)
+    query = parts.query
+
+    if protocol == "shadowsocks":
+        if not userinfo:
+            # Legacy form: ss://base64(method:password@host:port)#tag
+            decoded = decode_base64_text(hostport)
+            credential, _, hostport = decoded.rpartition("@")
+        elif ":" not in credential:
+            credential = decode_base64_text(userinfo)
+        if parts.path.startswith("/?") or not query and "?" in parts.path:
+            query = parts.path.split("?", 1)[1]
+
+    host_parts = urlsplit(f"//{hostport}")
+    return make_config_record(protocol, host_parts.hostname or "", host_parts.port, credential, parse_qsl(query, keep_blank_values=True))
+
+def parse_vmess_config(config):
+    data = config[len("vmess://"):].split("#", 1)[0]
+    try:
+        config_json = json.loads(decode_base64_text(data))
+    except Exception:
+        # Some clients share vmess in the same URL form as vless
+        return parse_url_config("vmess", config)
+
+    params = [(key, value) for key, value in config_json.items()
+              if key not in VMESS_IGNORED_KEYS and key not in ("add", "port", "id")]
+    return make_config_record("vmess", str(config_json.get("add", "")), config_json.get("port", 0), str(config_json.get("id", "")), params)
+
+def parse_config(config, protocol=None):
+    return parse_config_record(config, protocol or detect_config_protocol(config))
+
+@lru_cache(maxsize=65536)
+def parse_config_record(config, protocol):
     try:
         if protocol == "vmess":
-            config_data = config.split("vmess://")[1]
-            decoded = base64.b64decode(config_data).decode("utf-8")
-            config_json = json.loads(decoded)
-            return config_json.get("add", "")
-        else:
-            match = re.search(r"@([^\s:]+):", config)
-            if match:
-                return match.group(1)
-            match = re.search(r"{}://[^\s@]+?([^\s:]+):".format(protocol), config)
-            if match:
-                return match.group(1)
-        return None
+            return parse_vmess_config(config)
+        if protocol in ("vless", "trojan", "shadowsocks"):
+            return parse_url_config(protocol, config)
     except Exception as e:
-        logger.error(f"Failed to extract server address from {config}: {str(e)}")
+        logger.debug(f"Failed to parse {protocol} config {config}: {str(e)}")
+    return None
+
+def config_fingerprint(config, protocol=None):
+    record = parse_config(config, protocol)
+    return record.fingerprint if record else config
+
+def normalize_proxy_secret(secret):
+    secret = secret.strip()
+    if HEX_SECRET_REGEX.fullmatch(secret):
+        return secret.lower()
+    # Some clients share the same secret base64 (or base64url) encoded
+    try:
+        raw = base64.urlsafe_b64decode(secret.replace("+", "-").replace("/", "_") + "=" * (-len(secret) % 4))
+    except ValueError:
         return None
+    return raw.hex() if len(raw) >= 16 else None
 
-def extract_proxies_from_message(message):
+@lru_cache(maxsize=65536)
+def parse_proxy_link(link):
+    try:
+        parts = urlsplit(link.strip())
+        scheme = parts.scheme.lower()
+        if scheme == "tg":
+            if parts.netloc.lower() != "proxy":
+                return None
+        elif scheme not in ("http", "https") or parts.netloc.lower() not in ("t.me", "telegram.me") or parts.path != "/proxy":
+            return None
+        params = {key.lower(): value for key, value in parse_qsl(parts.query)}
+        server = params.get("server", "").strip().lower().rstrip(".")
+        port = int(params.get("port", ""))
+        secret = normalize_proxy_secret(params.get("secret", ""))
+    except ValueError:
+        return None
+    if not server or any(ch.isspace() for ch in server) or not 0 < port < 65536 or not secret:
+        return None
+    return ProxyRecord(server, port, secret)
+
+def canonical_proxy_link(record):
+    return f"https://t.me/proxy?server={record.server}&port={record.port}&secret={record.secret}"
+
+def proxy_fingerprint(proxy):
+    record = parse_proxy_link(proxy)
+    return f"{record.server}:{record.port}:{record.secret}" if record else proxy
+
+def normalize_proxy_links(links):
+    # Variants of the same server/port/secret collapse into one canonical https link
+    unique = {}
+    for link in links:
+        record = parse_proxy_link(link)
+        if record:
+            unique.setdefault(record, canonical_proxy_link(record))
+    return list(unique.values())
+
+def extract_server_address(config, protocol):
+    record = parse_config(config, protocol)
+    if record:
+        return record.host
+    logger.error(f"Failed to extract server address from {config}")
+    return None
+
+def build_operator_matcher(operators):
+    # detect_operator() returns the operator of the first keyword (in dict order)
+    # found in the text. A keyword that contains an earlier keyword of the same
+    # operator can never decide the result, so it is dropped up front and each
+    # message only pays for the substring searches that can matter.
+    matcher = []
+    for keyword, op in operators.items():
+        keyword = keyword.lower()
+        if any(earlier in keyword and earlier_op == op for earlier, earlier_op in matcher):
+            continue
+        matcher.append((keyword, op))
+    return matcher
+
+OPERATOR_MATCHER = build_operator_matcher(OPERATORS)
+
+def extract_links_from_text(text):
+    # One scan over the "://" occurrences of the text, dispatching on the scheme
+    # in front of each one. Results match re.findall() over CONFIG_PATTERNS and
+    # PROXY_PATTERN, including "ss://" matches inside vless/vmess links.
+    configs = {"vless": [], "vmess": [], "shadowsocks": [], "trojan": []}
+    vless, vmess, shadowsocks, trojan = configs["vless"], configs["vmess"], configs["shadowsocks"], configs["trojan"]
+    proxies = []
+    vless_end = vmess_end = shadowsocks_end = trojan_end = proxy_end = 0
+    run_end = -1
+    text_length = len(text)
+
+    pos = text.find("://")
+    while pos != -1:
+        body = pos + 3
+        scheme = text[pos - 6 if pos >= 6 else 0:pos]
+
+        if run_end < body:
+            match = WHITESPACE_REGEX.search(text, body)
+            run_end = match.start() if match else text_length
+
+        if run_end > body:
+            if scheme.endswith("ss"):
+                start = pos - 2
+                if start >= shadowsocks_end:
+                    shadowsocks.append(text[start:run_end])
+                    shadowsocks_end = run_end
+                if scheme.endswith("vless"):
+                    start = pos - 5
+                    if start >= vless_end:
+                        vless.append(text[start:run_end])
+                        vless_end = run_end
+                elif scheme.endswith("vmess"):
+                    start = pos - 5
+                    if start >= vmess_end:
+                        vmess.append(text[start:run_end])
+                        vmess_end = run_end
+            elif scheme == "trojan":
+                start = pos - 6
+                if start >= trojan_end:
+                    trojan.append(text[start:run_end])
+                    trojan_end = run_end
+
+        if scheme.endswith("tg"):
+            proxy_start = pos - 2 if text.startswith("proxy?", body) else -1
+        elif scheme.endswith("http") or scheme.endswith("https"):
+            proxy_start = pos - len("https" if scheme.endswith("https") else "http")
+            if not text.startswith(("t.me/proxy?", "telegram.me/proxy?"), body):
+                proxy_start = -1
+        else:
+            proxy_start = -1
+        if proxy_start >= proxy_end:
+            match = PROXY_REGEX.match(text, proxy_start)
+            if match:
+                proxies.append(match.group())
+                proxy_end = match.end()
+
+        pos = text.find("://", body)
+
+    return configs, proxies
+
+def extract_proxies_from_entities(message, text):
     proxies = []
-    proxies += re.findall(PROXY_PATTERN, message.message or "")
     if hasattr(message, 'entities') and message.entities:
-        text = message.message or ""
         for entity in message.entities:
             if isinstance(entity, (MessageEntityTextUrl, MessageEntityUrl)):
                 if hasattr(entity, 'url'):
@@ -108,14 +729,18 @@ def extract_proxies_from_message(message):
                     offset = entity.offset
                     length = entity.length
                     url = text[offset:offset+length]
-                if url.startswith("https://t.me/proxy?"):
+                if url.startswith(PROXY_LINK_PREFIXES):
                     proxies.append(url)
     return proxies
 
+def extract_proxies_from_message(message):
+    text = message.message or ""
+    return normalize_proxy_links(extract_links_from_text(text)[1] + extract_proxies_from_entities(message, text))
+
 def detect_operator(text):
     text_lower = text.lower()
-    for keyword, op in OPERATORS.items():
-        if keyword.lower() in text_lower:
+    for keyword, op in OPERATOR_MATCHER:
+        if keyword in text_lower:
             return op
     return None
 
@@ -123,20 +748,35 @@ def extract_npvt_password(text):
     if not text:
         return None
 
-    patterns = [
-        r"(?:رمز\s*عبور|رمز|پسورد|password|pass)\s*[:=\-]\s*[`'\"]?([^\s\n`'\"]+)[`'\"]?",
-        r"(?:رمز\s*عبور|رمز|پسورد|password|pass)\s*\n+\s*([^\s\n`'\"]+)"
-    ]
-
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for regex in NPVT_PASSWORD_REGEXES:
+        match = regex.search(text)
         if match:
             candidate = match.group(1).strip()
-            if re.fullmatch(r'[a-zA-Z0-9!@#$%^&*_\-+=.]+', candidate):
+            if NPVT_PASSWORD_CHARSET_REGEX.fullmatch(candidate):
                 return candidate
 
     return None
-    return None
+
+def extract_message(message):
+    result = {
+        "operator": None,
+        "configs": {"vless": [], "vmess": [], "shadowsocks": [], "trojan": []},
+        "proxies": [],
+        "npvt_file_name": extract_npvt_filename(message),
+        "npvt_password": None
+    }
+
+    text = message.message or ""
+    if result["npvt_file_name"]:
+        result["npvt_password"] = extract_npvt_password(text)
+
+    if isinstance(message, Message) and text:
+        result["operator"] = detect_operator(text)
+        result["configs"], text_proxies = extract_links_from_text(text)
+        result["proxies"] = normalize_proxy_links(text_proxies + extract_proxies_from_entities(message, text))
+
+    return result
+
 def extract_npvt_filename(message):
     file_name = None
     if getattr(message, "file", None):
@@ -152,172 +792,1323 @@ def extract_npvt_filename(message):
         return file_name
     return None
 
-async def fetch_configs_and_proxies_from_channel(client, channel):
+def normalize_channel_candidate(reference):
+    if extract_invite_hash(reference):
+        # Private invites can only be probed by joining them
+        return None
+    candidate = parse_channel_identifier(reference)
+    if not isinstance(candidate, str) or not CHANNEL_USERNAME_REGEX.fullmatch(candidate):
+        return None
+    name = candidate[1:].lower()
+    if name in RESERVED_TME_PATHS or name.endswith("bot"):
+        return None
+    return candidate
+
+def extract_channel_mentions(message):
+    text = message.message or ""
+    references = [match.group(1) for match in CHANNEL_LINK_REGEX.finditer(text)]
+    for entity in message.entities or []:
+        if isinstance(entity, MessageEntityTextUrl):
+            match = CHANNEL_LINK_REGEX.match(entity.url or "")
+            if match:
+                references.append(match.group(1))
+        elif isinstance(entity, MessageEntityMention):
+            references.append(text[entity.offset:entity.offset + entity.length])
+
+    if getattr(message, "fwd_from", None) is not None:
+        try:
+            chat = message.forward.chat
+        except Exception:
+            chat = None
+        if getattr(chat, "username", None):
+            references.append(chat.username)
+
+    candidates = {}
+    for reference in references:
+        candidate = normalize_channel_candidate(reference)
+        if candidate:
+            candidates.setdefault(candidate.lower(), candidate)
+    return list(candidates.values())
+
+# Open-addressing hash table of 64-bit config/proxy digests and the time each
+# was last seen, memory-mapped so a run only pages in the slots it probes.
+# Entries older than max_age count as new again and are dropped on the next rebuild.
+class SeenIndex:
+    MAGIC = b"SEEN"
+    HEADER = struct.Struct("<4sII")
+    SLOT = struct.Struct("<QI")
+
+    def __init__(self, path, max_age=SEEN_INDEX_MAX_AGE, refresh_after=SEEN_INDEX_REFRESH):
+        self.path = path
+        self.max_age = max_age
+        self.refresh_after = refresh_after
+        self.file = None
+        self.map = None
+        try:
+            self.open()
+        except Exception as e:
+            logger.warning(f"Seen index {path} is missing or unreadable ({str(e)}), starting a new one")
+            self.close()
+            self.write([], SEEN_INDEX_MIN_SLOTS)
+            self.open()
+
+    @staticmethod
+    def digest(value):
+        # Zero marks an empty slot
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+    def open(self):
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.slots, self.used = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC or self.slots & (self.slots - 1) or len(self.map) != self.HEADER.size + self.slots * self.SLOT.size:
+            raise ValueError("unexpected header")
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def find(self, digest):
+        mask = self.slots - 1
+        index = digest & mask
+        while True:
+            offset = self.HEADER.size + index * self.SLOT.size
+            slot_digest, last_seen = self.SLOT.unpack_from(self.map, offset)
+            if slot_digest == digest:
+                return offset, last_seen
+            if slot_digest == 0:
+                return offset, None
+            index = (index + 1) & mask
+
+    def contains(self, value, now=None):
+        now = int(now or time.time())
+        last_seen = self.find(self.digest(value))[1]
+        return last_seen is not None and now - last_seen <= self.max_age
+
+    def add(self, value, now=None):
+        # Returns True when the value is new (never seen, or aged out)
+        now = int(now or time.time())
+        digest = self.digest(value)
+        offset, last_seen = self.find(digest)
+        if last_seen is None:
+            if (self.used + 1) * 10 > self.slots * 7:
+                self.rebuild(now)
+                offset, last_seen = self.find(digest)
+            self.used += 1
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.slots, self.used)
+        elif now - last_seen <= self.refresh_after:
+            # Known and recently refreshed: leave the slot alone so the file only changes with new items
+            return False
+        self.SLOT.pack_into(self.map, offset, digest, now)
+        return last_seen is None or now - last_seen > self.max_age
+
+    def live_entries(self, now):
+        return [
+            (digest, last_seen)
+            for digest, last_seen in self.SLOT.iter_unpack(self.map[self.HEADER.size:])
+            if digest and now - last_seen <= self.max_age
+        ]
+
+    def write(self, entries, slots):
+        table = bytearray(self.HEADER.size + slots * self.SLOT.size)
+        self.HEADER.pack_into(table, 0, self.MAGIC, slots, len(entries))
+        mask = slots - 1
+        for digest, last_seen in entries:
+            index = digest & mask
+            offset = self.HEADER.size + index * self.SLOT.size
+            while self.SLOT.unpack_from(table, offset)[0]:
+                index = (index + 1) & mask
+                offset = self.HEADER.size + index * self.SLOT.size
+            self.SLOT.pack_into(table, offset, digest, last_seen)
+        write_file_atomic(self.path, bytes(table))
+
+    def rebuild(self, now):
+        # Drops aged-out entries and resizes to a quarter load, which also shrinks the file
+        entries = self.live_entries(now)
+        slots = SEEN_INDEX_MIN_SLOTS
+        while slots < len(entries) * 4:
+            slots *= 2
+        self.close()
+        self.write(entries, slots)
+        self.open()
+        logger.info(f"Rebuilt seen index with {len(entries)} live entries in {slots} slots")
+
+    def flush(self):
+        self.map.flush()
+
+seen_index = None
+# Items first seen since the last publish; everything else in the index is known
+run_new_items = set()
+
+def open_seen_index():
+    global seen_index
+    if SEEN_INDEX_ENABLED and seen_index is None:
+        seen_index = SeenIndex(SEEN_INDEX_FILE)
+        logger.info(f"Opened seen index {SEEN_INDEX_FILE} ({seen_index.used} entries in {seen_index.slots} slots)")
+    return seen_index
+
+def save_seen_index():
+    if seen_index is not None:
+        seen_index.flush()
+        logger.info(f"Saved seen index ({seen_index.used} entries) to {SEEN_INDEX_FILE}")
+
+def count_new_items(items, now=None):
+    if seen_index is None:
+        return len(items)
+    new_items = [item for item in items if seen_index.add(item, now)]
+    run_new_items.update(new_items)
+    return len(new_items)
+
+def known_items(items):
+    if seen_index is None:
+        return set()
+    now = time.time()
+    return {item for item in items if item not in run_new_items and seen_index.contains(item, now)}
+
+def known_item_ttl(ttl):
+    # Known items keep their last good result for as long as the seen index remembers them
+    return max(ttl, SEEN_INDEX_MAX_AGE) if seen_index is not None else ttl
+
+def mark_records_seen(channel, records):
+    # Called once a scan has succeeded, so a retried scan still sees its items as new
+    now = time.time()
+    for record in records:
+        record["new_items"] = 0
+        # Items already collected on earlier runs are still kept, only not reported again
+        for protocol, matches in record["configs"].items():
+            new_count = count_new_items(matches, now)
+            if new_count:
+                logger.info(f"[{channel}] Found {new_count} new of {len(matches)} {protocol} configs in message {record['id']}")
+                print(f"✅ [{channel}] Found {new_count} new {protocol} configs")
+            record["new_items"] += new_count
+
+        if record["proxies"]:
+            new_count = count_new_items(record["proxies"], now)
+            if new_count:
+                logger.info(f"[{channel}] Found {new_count} new of {len(record['proxies'])} proxies in message {record['id']}")
+                print(f"✅ [{channel}] Found {new_count} new proxies")
+            record["new_items"] += new_count
+
+def extract_message_record(message, channel, extraction=None):
+    if extraction is None:
+        extraction = extract_message(message)
+
+    record = {
+        "id": message.id,
+        "date": message.date.isoformat(),
+        "operator": extraction["operator"],
+        "configs": {},
+        "proxies": [],
+        "npvt": None,
+        "new_items": 0
+    }
+
+    for protocol, matches in extraction["configs"].items():
+        if matches:
+            record["configs"][protocol] = matches
+
+    if extraction["proxies"]:
+        record["proxies"] = extraction["proxies"]
+
+    return record
+
+message_archive_buffer = []
+discovery_mentions = defaultdict(int)
+
+def archive_message(message, channel):
+    if not MESSAGE_ARCHIVE_ENABLED or not message.date:
+        return
+
+    entry = {
+        "channel": str(channel),
+        "id": message.id,
+        "date": message.date.isoformat(),
+        "text": message.message or "",
+        "entities": [],
+        "document": None
+    }
+    for entity in message.entities or []:
+        item = {"type": type(entity).__name__, "offset": entity.offset, "length": entity.length}
+        if getattr(entity, "url", None):
+            item["url"] = entity.url
+        entry["entities"].append(item)
+
+    document = getattr(message, "document", None)
+    if document is not None and getattr(document, "id", None) is not None:
+        file_name = None
+        for attr in getattr(document, "attributes", None) or []:
+            if hasattr(attr, "file_name"):
+                file_name = attr.file_name
+                break
+        entry["document"] = {
+            "id": document.id,
+            "access_hash": getattr(document, "access_hash", 0),
+            "file_name": file_name,
+            "mime_type": getattr(document, "mime_type", None),
+            "size": getattr(document, "size", None)
+        }
+    message_archive_buffer.append(entry)
+
+def message_archive_path(day):
+    return os.path.join(MESSAGE_ARCHIVE_DIR, f"messages-{day.isoformat()}.jsonl.gz")
+
+def list_message_archive_days():
+    days = []
+    if os.path.isdir(MESSAGE_ARCHIVE_DIR):
+        for name in os.listdir(MESSAGE_ARCHIVE_DIR):
+            match = re.fullmatch(r"messages-(\d{4}-\d{2}-\d{2})\.jsonl\.gz", name)
+            if match:
+                days.append(datetime.strptime(match.group(1), "%Y-%m-%d").date())
+    return sorted(days)
+
+def prune_message_archive(retention_days=MESSAGE_ARCHIVE_RETENTION_DAYS):
+    if retention_days <= 0:
+        return
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=retention_days)
+    for day in list_message_archive_days():
+        if day < cutoff:
+            os.remove(message_archive_path(day))
+            logger.info(f"Removed archived messages from {day}, older than {retention_days} days")
+
+def flush_message_archive():
+    if not message_archive_buffer:
+        return
+    entries_by_day = defaultdict(list)
+    for entry in message_archive_buffer:
+        entries_by_day[datetime.fromisoformat(entry["date"]).date()].append(entry)
+    try:
+        os.makedirs(MESSAGE_ARCHIVE_DIR, exist_ok=True)
+        # Messages go to the file of the day they were posted; every flush appends a new gzip member
+        for day, entries in sorted(entries_by_day.items()):
+            with gzip.open(message_archive_path(day), "at", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        logger.info(f"Archived {len(message_archive_buffer)} messages to {MESSAGE_ARCHIVE_DIR}")
+        message_archive_buffer.clear()
+        prune_message_archive()
+    except Exception as e:
+        logger.error(f"Failed to archive messages to {MESSAGE_ARCHIVE_DIR}: {str(e)}")
+
+def load_message_archive(min_day=None):
+    entries = {}
+    days = [day for day in list_message_archive_days() if min_day is None or day >= min_day]
+    for day in days:
+        path = message_archive_path(day)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    # A message seen again (daemon and catch-up run) keeps its latest copy
+                    entries[(entry["channel"], entry["id"])] = entry
+        except (EOFError, OSError) as e:
+            logger.warning(f"Message archive {path} ends early, using what was read: {str(e)}")
+    logger.info(f"Loaded {len(entries)} archived messages from {len(days)} days in {MESSAGE_ARCHIVE_DIR}")
+    return list(entries.values())
+
+def archived_entry_to_message(entry):
+    # Only the entity kinds the extractor reads are rebuilt
+    entities = []
+    for item in entry.get("entities", []):
+        if item["type"] == "MessageEntityTextUrl":
+            entities.append(MessageEntityTextUrl(item["offset"], item["length"], item.get("url", "")))
+        elif item["type"] == "MessageEntityUrl":
+            entities.append(MessageEntityUrl(item["offset"], item["length"]))
+
+    media = None
+    document = entry.get("document")
+    if document:
+        attributes = [DocumentAttributeFilename(document["file_name"])] if document.get("file_name") else []
+        media = MessageMediaDocument(document=Document(
+            id=document["id"],
+            access_hash=document.get("access_hash") or 0,
+            file_reference=b"",
+            date=None,
+            mime_type=document.get("mime_type") or "",
+            size=document.get("size") or 0,
+            dc_id=0,
+            attributes=attributes
+        ))
+
+    return Message(
+        id=entry["id"],
+        peer_id=None,
+        date=datetime.fromisoformat(entry["date"]),
+        message=entry.get("text", ""),
+        entities=entities or None,
+        media=media
+    )
+
+async def iter_history_pages(client, channel_entity, channel, limit, min_id=0):
+    # Each page is its own scheduled request, so a flood wait only repeats that page
+    offset_id = 0
+    while limit > 0:
+        page_size = min(HISTORY_PAGE_SIZE, limit)
+        with run_metrics.timed("history", channel):
+            page = await client_scheduler(client).call(
+                "history", client.get_messages, channel_entity, limit=page_size, offset_id=offset_id, min_id=min_id
+            )
+        for message in page:
+            yield message
+        if len(page) < page_size:
+            return
+        limit -= len(page)
+        offset_id = page[-1].id
+
+async def scan_channel_messages(client, channel_entity, channel, cursor, min_date, npvt_queue=None):
+    message_count = 0
+    last_message_id = cursor.get("last_message_id", 0)
+    last_message_date = cursor.get("last_message_date")
+    # Only the delta since the previous run is requested from Telegram
+    messages_iter = iter_history_pages(client, channel_entity, channel, 150, last_message_id)
+
+    new_records = []
+    pending_downloads = []
+    try:
+        async for message in messages_iter:
+            message_count += 1
+            if message.date:
+                message_date = message.date.date()
+            else:
+                continue
+
+            if message_date < min_date:
+                # Results are newest first, so nothing older is worth paging in
+                break
+
+            if message.id > last_message_id:
+                last_message_id = message.id
+                last_message_date = message.date.isoformat()
+
+            with run_metrics.timed("extract", channel):
+                extraction = extract_message(message)
+                record = extract_message_record(message, channel, extraction)
+            archive_message(message, channel)
+            if DISCOVERY_ENABLED:
+                for candidate in extract_channel_mentions(message):
+                    discovery_mentions[candidate] += 1
+            if run_metrics.enabled:
+                run_metrics.add_bytes("history", len((message.message or "").encode("utf-8")), channel)
+            if extraction["npvt_file_name"]:
+                if npvt_queue is None:
+                    record["npvt"] = await download_npvt_from_message(
+                        client, message, channel, extraction["npvt_file_name"], extraction["npvt_password"]
+                    )
+                else:
+                    # Blocks only while the queue is full, so parsing keeps running during transfers
+                    future = asyncio.get_running_loop().create_future()
+                    await npvt_queue.put((message, channel, extraction["npvt_file_name"], extraction["npvt_password"], future))
+                    pending_downloads.append((record, future))
+            new_records.append(record)
+    except BaseException:
+        # Queued downloads of an abandoned scan are not waited for
+        for record, future in pending_downloads:
+            future.cancel()
+        raise
+
+    with run_metrics.timed("npvt_wait", channel):
+        for record, future in pending_downloads:
+            record["npvt"] = await future
+
+    return message_count, new_records, last_message_id, last_message_date
+
+def collect_channel_records(channel, records):
+    configs = {"vless": [], "vmess": [], "shadowsocks": [], "trojan": []}
+    config_timeline = []
+    operator_configs = defaultdict(list)
+    proxies = []
+    proxy_timeline = []
+    npvt_files = []
+
+    source = sys.intern(str(channel))
+    for record in records:
+        operator = record.get("operator")
+        for protocol, matches in record.get("configs", {}).items():
+            configs[protocol].extend(matches)
+            label = sys.intern(protocol.capitalize())
+            for config in matches:
+                config_timeline.append(TimelineItem(label, config, source))
+            if operator:
+                for config in matches:
+                    operator_configs[operator].append(config)
+
+        proxies.extend(record.get("proxies", []))
+        for proxy in record.get("proxies", []):
+            proxy_timeline.append(ProxyItem(proxy, source))
+
+        npvt = record.get("npvt")
+        if npvt and os.path.exists(npvt["file_path"]):
+            npvt_files.append({
+                "file_path": npvt["file_path"],
+                "password": npvt["password"],
+                "source": source
+            })
+
+    return configs, config_timeline, operator_configs, proxies, npvt_files, proxy_timeline
+
+async def refetch_carried_npvt(client, channel_entity, channel, records, npvt_queue=None):
+    # Carried records only keep the blob path, which is gone on a fresh checkout
+    # (every CI run), so their messages are fetched again by id and re-downloaded
+    try:
+        messages = await client_scheduler(client).call(
+            "history", client.get_messages, channel_entity, ids=[record["id"] for record in records]
+        )
+    except (FloodWaitError, UnauthorizedError):
+        raise
+    except Exception as e:
+        logger.error(f"[{channel}] Failed to refetch {len(records)} NPVT messages: {str(e)}")
+        return
+
+    messages_by_id = {message.id: message for message in messages if message is not None}
+    pending_downloads = []
+    for record in records:
+        message = messages_by_id.get(record["id"])
+        file_name = extract_npvt_filename(message) if message else None
+        if not file_name:
+            logger.warning(f"[{channel}] NPVT message {record['id']} is no longer available")
+            record["npvt"] = None
+            continue
+        password = record["npvt"].get("password")
+        if npvt_queue is None:
+            record["npvt"] = await download_npvt_from_message(client, message, channel, file_name, password)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            await npvt_queue.put((message, channel, file_name, password, future))
+            pending_downloads.append((record, future))
+
+    with run_metrics.timed("npvt_wait", channel):
+        for record, future in pending_downloads:
+            record["npvt"] = await future
+
+async def fetch_configs_and_proxies_from_channel(client, channel, cursors=None, npvt_queue=None, history=None):
     configs = {"vless": [], "vmess": [], "shadowsocks": [], "trojan": []}
     config_timeline = []
     operator_configs = defaultdict(list)
     proxies = []
     proxy_timeline = []
     npvt_files = []
+    if cursors is None:
+        cursors = {}
+    if history is None:
+        history = {}
+    cursor = cursors.get(str(channel)) or {}
     try:
-        channel_entity = await resolve_channel_target(client, channel)
+        with run_metrics.timed("resolve", channel):
+            channel_entity = await resolve_channel_target(client, channel)
+    except FloodWaitError as e:
+        record_channel_throttled(history, channel, e.seconds)
+        raise
+    except UnauthorizedError:
+        raise
     except (ChannelInvalidError, PeerIdInvalidError, ValueError) as e:
         logger.error(f"Channel {channel} does not exist or is inaccessible: {str(e)}")
+        record_channel_failure(history, channel)
         return configs, config_timeline, operator_configs, proxies, npvt_files, proxy_timeline, False
     except Exception as e:
         logger.error(f"Channel {channel} could not be resolved: {str(e)}")
+        record_channel_failure(history, channel)
         return configs, config_timeline, operator_configs, proxies, npvt_files, proxy_timeline, False
 
     try:
-        message_count = 0
-        configs_found_count = 0
         today = datetime.now().date()
         yesterday = today - timedelta(days=1)
         min_date = yesterday
 
-        async for message in client.iter_messages(channel_entity, limit=150):
-            message_count += 1
-            if message.date:
-                message_date = message.date.date()
-            else:
-                continue
-
-            if message_date < min_date:
-                continue
-
-            downloaded_npvt = await download_npvt_from_message(client, message, channel)
-            if downloaded_npvt:
-                npvt_files.append({
-                    "file_path": downloaded_npvt["file_path"],
-                    "password": downloaded_npvt["password"],
-                    "source": str(channel)
-                })
+        try:
+            message_count, new_records, last_message_id, last_message_date = await scan_channel_messages(
+                client, channel_entity, channel, cursor, min_date, npvt_queue
+            )
+        except (ChannelInvalidError, PeerIdInvalidError) as e:
+            if not invalidate_cached_entity(channel, client):
+                raise
+            logger.warning(f"Cached entity for {channel} is stale ({str(e)}), resolving again")
+            channel_entity = await resolve_channel_target(client, channel)
+            message_count, new_records, last_message_id, last_message_date = await scan_channel_messages(
+                client, channel_entity, channel, cursor, min_date, npvt_queue
+            )
 
-            if isinstance(message, Message) and message.message:
-                text = message.message
-
-                operator = detect_operator(text)
-
-                for protocol, pattern in CONFIG_PATTERNS.items():
-                    matches = re.findall(pattern, text)
-                    if matches:
-                        logger.info(f"[{channel}] Found {len(matches)} {protocol} configs in message {message.id}")
-                        print(f"✅ [{channel}] Found {len(matches)} {protocol} configs")
-                        configs[protocol].extend(matches)
-                        for config in matches:
-                            config_timeline.append({
-                                "protocol": protocol.capitalize(),
-                                "config": config,
-                                "source": str(channel)
-                            })
-                        configs_found_count += len(matches)
-                        if operator:
-                            for config in matches:
-                                operator_configs[operator].append(config)
-
-                proxy_links = extract_proxies_from_message(message)
-                if proxy_links:
-                    logger.info(f"[{channel}] Found {len(proxy_links)} proxies in message {message.id}")
-                    print(f"✅ [{channel}] Found {len(proxy_links)} proxies")
-                    proxies.extend(proxy_links)
-                    for proxy in proxy_links:
-                        proxy_timeline.append({
-                            "proxy": proxy,
-                            "source": str(channel)
-                        })
-
-        summary = f"[{channel}] ✔️ Processed {message_count} messages → Found {configs_found_count} configs + {len(proxies)} proxies + {len(npvt_files)} npvt"
+        carried_records = [
+            record for record in cursor.get("recent_messages", [])
+            if datetime.fromisoformat(record["date"]).date() >= min_date
+        ]
+        mark_records_seen(channel, new_records)
+        missing_npvt = [
+            record for record in carried_records
+            if record.get("npvt") and not os.path.exists(record["npvt"]["file_path"])
+        ]
+        if missing_npvt:
+            await refetch_carried_npvt(client, channel_entity, channel, missing_npvt, npvt_queue)
+        recent_records = new_records + carried_records
+        queue_config_sightings(channel, new_records)
+        queue_config_sightings(channel, carried_records, carried=True)
+
+        configs, config_timeline, operator_configs, proxies, npvt_files, proxy_timeline = collect_channel_records(channel, recent_records)
+        configs_found_count = sum(len(matches) for matches in configs.values())
+
+        cursors[str(channel)] = {
+            "last_message_id": last_message_id,
+            "last_message_date": last_message_date,
+            "recent_messages": [
+                record for record in recent_records
+                if record["configs"] or record["proxies"] or record["npvt"]
+            ][:CURSOR_MAX_RECORDS]
+        }
+
+        # Reposts of already known items do not count towards the channel's polling yield
+        new_items = sum(record["new_items"] + bool(record["npvt"]) for record in new_records)
+        record_channel_success(history, channel, new_items)
+
+        summary = f"[{channel}] ✔️ Processed {message_count} new messages → Found {configs_found_count} configs + {len(proxies)} proxies + {len(npvt_files)} npvt ({new_items} new)"
         logger.info(summary)
         print(summary)
         return configs, config_timeline, operator_configs, proxies, npvt_files, proxy_timeline, True
+    except FloodWaitError as e:
+        # Throttling is transient; the channel is retried after the wait instead of backing off
+        record_channel_throttled(history, channel, e.seconds)
+        raise
+    except UnauthorizedError:
+        # The account is at fault, not the channel; the pool retries it elsewhere
+        raise
     except Exception as e:
         logger.error(f"Failed to fetch from {channel}: {str(e)}")
         print(f"❌ [{channel}] Error: {str(e)}")
+        record_channel_failure(history, channel)
         return configs, config_timeline, operator_configs, proxies, npvt_files, proxy_timeline, False
 
 
-async def download_npvt_from_message(client, message, channel):
-    file_name = extract_npvt_filename(message)
-    if not file_name:
-        return None
+npvt_index = None
+npvt_inflight = {}
 
-    password = extract_npvt_password(message.message or "")
+def load_npvt_index():
+    global npvt_index
+    if npvt_index is not None:
+        return npvt_index
 
-    safe_channel = re.sub(r"[^\w\-\.]+", "_", str(channel))
-    base_name = os.path.basename(file_name)
-    output_name = f"{safe_channel}_{message.id}_{base_name}"
-    output_path = os.path.join(NPVT_DIR, output_name)
+    npvt_index = {"documents": {}, "blobs": {}, "messages": {}}
+    if os.path.exists(NPVT_INDEX_FILE):
+        try:
+            with open(NPVT_INDEX_FILE, "r", encoding="utf-8") as f:
+                npvt_index.update(json.load(f))
+            logger.info(f"Loaded {len(npvt_index['blobs'])} NPVT blobs from {NPVT_INDEX_FILE}")
+        except Exception as e:
+            logger.error(f"Failed to load NPVT index from {NPVT_INDEX_FILE}: {str(e)}")
+    return npvt_index
+
+def save_npvt_index():
+    index = load_npvt_index()
+    write_output_file(NPVT_INDEX_FILE, json.dumps(index, ensure_ascii=False, indent=4))
+    logger.info(f"Saved NPVT index with {len(index['blobs'])} blobs to {NPVT_INDEX_FILE}")
 
-    if os.path.exists(output_path):
-        logger.info(f"[{channel}] NPVT already downloaded: {output_path}")
-        return {"file_path": output_path, "password": password}
+def npvt_document_key(message):
+    document = getattr(message, "document", None)
+    if document is None or getattr(document, "id", None) is None:
+        return None
+    return f"{document.id}_{getattr(document, 'access_hash', 0)}"
+
+def lookup_npvt_blob(index, blob_hash):
+    blob = index["blobs"].get(blob_hash) if blob_hash else None
+    if blob and os.path.exists(blob["path"]):
+        blob["last_used"] = time.time()
+        return blob
+    return None
 
+async def stream_npvt_download(client, message, base_name, channel=None):
+    temp_path = os.path.join(NPVT_DIR, f".{message.id}_{os.getpid()}_{id(message)}.part")
+    digest = hashlib.sha256()
+    size = 0
     try:
-        downloaded_path = await client.download_media(message, file=output_path)
-        if downloaded_path:
-            logger.info(f"[{channel}] Downloaded NPVT: {downloaded_path} | password: {password}")
-            print(f"✅ [{channel}] Downloaded NPVT: {os.path.basename(downloaded_path)}" +
+        chunks = client.iter_download(message.media).__aiter__()
+        with open(temp_path, "wb") as f:
+            while True:
+                # The token is taken before each chunk is requested, not after it arrived
+                await client_scheduler(client).acquire("download")
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+
+        run_metrics.add_bytes("download", size, channel)
+        blob_hash = digest.hexdigest()
+        index = load_npvt_index()
+        blob = lookup_npvt_blob(index, blob_hash)
+        if blob:
+            os.remove(temp_path)
+            return blob_hash, blob
+
+        blob_path = os.path.join(NPVT_DIR, f"{blob_hash[:16]}_{base_name}")
+        os.replace(temp_path, blob_path)
+        blob = {"path": blob_path, "size": size, "last_used": time.time()}
+        index["blobs"][blob_hash] = blob
+        return blob_hash, blob
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+async def download_npvt_from_message(client, message, channel, file_name=None, password=None, timeout=None):
+    if file_name is None:
+        file_name = extract_npvt_filename(message)
+        if not file_name:
+            return None
+        password = extract_npvt_password(message.message or "")
+
+    index = load_npvt_index()
+    base_name = re.sub(r"[^\w\-\.]+", "_", os.path.basename(file_name))
+    message_key = f"{channel}:{message.id}"
+
+    entry = index["messages"].get(message_key)
+    blob = lookup_npvt_blob(index, entry["blob"]) if entry else None
+    if blob:
+        logger.info(f"[{channel}] NPVT already downloaded: {blob['path']}")
+        return {"file_path": blob["path"], "password": entry["password"]}
+
+    document_key = npvt_document_key(message)
+    blob_hash = index["documents"].get(document_key) if document_key else None
+    blob = lookup_npvt_blob(index, blob_hash)
+
+    if blob:
+        logger.info(f"[{channel}] NPVT {file_name} already cached as {blob['path']}")
+    elif client is None:
+        logger.info(f"[{channel}] NPVT {file_name} is not cached, skipped offline")
+        return None
+    else:
+        try:
+            # The same document forwarded by several channels is only fetched once
+            download = npvt_inflight.get(document_key) if document_key else None
+            if download is None:
+                download = asyncio.ensure_future(asyncio.wait_for(
+                    client_scheduler(client).call("download", stream_npvt_download, client, message, base_name, channel),
+                    timeout
+                ))
+                if document_key:
+                    npvt_inflight[document_key] = download
+            try:
+                with run_metrics.timed("download", channel):
+                    blob_hash, blob = await asyncio.shield(download)
+            finally:
+                if document_key and download.done():
+                    npvt_inflight.pop(document_key, None)
+            logger.info(f"[{channel}] Downloaded NPVT: {blob['path']} | password: {password}")
+            print(f"✅ [{channel}] Downloaded NPVT: {os.path.basename(blob['path'])}" +
                   (f" | 🔑 Pass: {password}" if password else ""))
-            return {"file_path": downloaded_path, "password": password}
+        except Exception as e:
+            logger.error(f"[{channel}] Failed to download NPVT from message {message.id}: {str(e)}")
+            return None
+
+    if document_key:
+        index["documents"][document_key] = blob_hash
+    index["messages"][message_key] = {"blob": blob_hash, "password": password}
+    return {"file_path": blob["path"], "password": password}
+
+def collect_npvt_garbage(max_bytes=NPVT_CACHE_MAX_BYTES, max_age=NPVT_CACHE_MAX_AGE):
+    index = load_npvt_index()
+    now = time.time()
+    blobs = index["blobs"]
+
+    removed = set()
+    total_size = 0
+    # Newest first: everything past the age limit or the size cap is evicted
+    for blob_hash, blob in sorted(blobs.items(), key=lambda item: item[1]["last_used"], reverse=True):
+        if not os.path.exists(blob["path"]):
+            removed.add(blob_hash)
+            continue
+        if now - blob["last_used"] > max_age or total_size + blob["size"] > max_bytes:
+            os.remove(blob["path"])
+            removed.add(blob_hash)
+            continue
+        total_size += blob["size"]
+
+    for blob_hash in removed:
+        del blobs[blob_hash]
+    index["documents"] = {key: value for key, value in index["documents"].items() if value in blobs}
+    index["messages"] = {key: value for key, value in index["messages"].items() if value["blob"] in blobs}
+
+    known_paths = {os.path.abspath(blob["path"]) for blob in blobs.values()}
+    known_paths.add(os.path.abspath(NPVT_INDEX_FILE))
+    stray_count = 0
+    for name in os.listdir(NPVT_DIR):
+        path = os.path.abspath(os.path.join(NPVT_DIR, name))
+        # Leftovers from the old per-message naming, or partial downloads of a crashed run
+        if path not in known_paths and os.path.isfile(path) and now - os.path.getmtime(path) > 3600:
+            os.remove(path)
+            stray_count += 1
+
+    logger.info(f"NPVT cache GC removed {len(removed)} blobs and {stray_count} stray files, {len(blobs)} blobs ({total_size} bytes) kept")
+
+async def npvt_download_worker(client, npvt_queue, timeout=NPVT_DOWNLOAD_TIMEOUT):
+    while True:
+        message, channel, file_name, password, future = await npvt_queue.get()
+        try:
+            result = await download_npvt_from_message(client, message, channel, file_name, password, timeout)
+        except Exception as e:
+            logger.error(f"[{channel}] NPVT download worker failed on message {message.id}: {str(e)}")
+            result = None
+        finally:
+            npvt_queue.task_done()
+        if not future.done():
+            future.set_result(result)
+
+async def fetch_all_channels(client, channels, max_concurrency=MAX_CONCURRENT_CHANNELS, cursors=None, download_workers=NPVT_DOWNLOAD_WORKERS, aggregator=None, history=None):
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    npvt_queue = asyncio.Queue(maxsize=max(1, NPVT_QUEUE_SIZE))
+    workers = [
+        asyncio.create_task(npvt_download_worker(client, npvt_queue))
+        for _ in range(max(1, download_workers))
+    ]
+
+    async def fetch_one(channel):
+        async with semaphore:
+            logger.info(f"Fetching configs/proxies from {channel}...")
+            print(f"\n📡 Fetching from {channel}...")
+            try:
+                result = await fetch_configs_and_proxies_from_channel(client, channel, cursors, npvt_queue, history)
+            except Exception as e:
+                result = e
+        if aggregator is None:
+            return result
+        # Folded in as soon as the channel finishes, so raw matches never pile up across channels
+        aggregator.add(channel, result)
+        return None
+
+    logger.info(f"Fetching {len(channels)} channels with up to {max_concurrency} in flight and {len(workers)} NPVT download workers")
+    try:
+        tasks = [asyncio.create_task(fetch_one(channel)) for channel in channels]
+        # gather() keeps results in channel-file order regardless of completion order
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await npvt_queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+config_store = None
+config_store_batch = []
+
+def open_config_store():
+    global config_store
+    if config_store is None:
+        config_store = sqlite3.connect(CONFIG_STORE_FILE)
+        config_store.executescript("""
+            CREATE TABLE IF NOT EXISTS configs (
+                fingerprint TEXT PRIMARY KEY,
+                config TEXT NOT NULL,
+                protocol TEXT NOT NULL,
+                source TEXT,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS configs_protocol ON configs (protocol, last_seen);
+            CREATE INDEX IF NOT EXISTS configs_last_seen ON configs (last_seen);
+            -- A config posted under several operator hashtags belongs to every one of them
+            CREATE TABLE IF NOT EXISTS config_operators (
+                fingerprint TEXT NOT NULL,
+                operator TEXT NOT NULL,
+                last_seen REAL NOT NULL,
+                PRIMARY KEY (fingerprint, operator)
+            );
+            CREATE INDEX IF NOT EXISTS config_operators_operator ON config_operators (operator, last_seen);
+        """)
+        columns = [row[1] for row in config_store.execute("PRAGMA table_info(configs)")]
+        if "operator" in columns:
+            # Stores created before config_operators kept a single operator per config
+            with config_store:
+                config_store.execute("""
+                    INSERT OR IGNORE INTO config_operators (fingerprint, operator, last_seen)
+                    SELECT fingerprint, operator, last_seen FROM configs WHERE operator IS NOT NULL
+                """)
+                config_store.execute("DROP INDEX IF EXISTS configs_operator")
+                config_store.execute("ALTER TABLE configs DROP COLUMN operator")
+        logger.info(f"Opened config store {CONFIG_STORE_FILE}")
+    return config_store
+
+def queue_config_sightings(channel, records, carried=False):
+    if not CONFIG_STORE_ENABLED:
+        return
+    for record in records:
+        seen_at = datetime.fromisoformat(record["date"]).timestamp()
+        for protocol, matches in record.get("configs", {}).items():
+            for config in matches:
+                config_store_batch.append((
+                    config_fingerprint(config, protocol), config, protocol,
+                    record.get("operator"), str(channel), seen_at, seen_at, carried
+                ))
+
+def flush_config_store():
+    if not config_store_batch:
+        return
+    store = open_config_store()
+    sightings = [row[:3] + row[4:7] for row in config_store_batch if not row[7]]
+    # Records carried over from an earlier run were counted then; they only fill gaps
+    carried = [row[:3] + row[4:7] for row in config_store_batch if row[7]]
+    operator_sightings = [(row[0], row[3], row[6]) for row in config_store_batch if row[3]]
+    with store:
+        store.executemany("""
+            INSERT INTO configs (fingerprint, config, protocol, source, first_seen, last_seen, hits)
+            VALUES (?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT (fingerprint) DO UPDATE SET
+                config = CASE WHEN excluded.last_seen >= configs.last_seen THEN excluded.config ELSE configs.config END,
+                source = CASE WHEN excluded.last_seen >= configs.last_seen THEN excluded.source ELSE configs.source END,
+                first_seen = MIN(configs.first_seen, excluded.first_seen),
+                last_seen = MAX(configs.last_seen, excluded.last_seen),
+                hits = configs.hits + 1
+        """, sightings)
+        store.executemany("""
+            INSERT OR IGNORE INTO configs (fingerprint, config, protocol, source, first_seen, last_seen, hits)
+            VALUES (?, ?, ?, ?, ?, ?, 1)
+        """, carried)
+        store.executemany("""
+            INSERT INTO config_operators (fingerprint, operator, last_seen) VALUES (?, ?, ?)
+            ON CONFLICT (fingerprint, operator) DO UPDATE SET
+                last_seen = MAX(config_operators.last_seen, excluded.last_seen)
+        """, operator_sightings)
+        cutoff = time.time() - CONFIG_STORE_RETENTION
+        expired = store.execute("DELETE FROM configs WHERE last_seen < ?", (cutoff,)).rowcount
+        store.execute("DELETE FROM config_operators WHERE last_seen < ?", (cutoff,))
+    logger.info(f"Stored {len(sightings)} config sightings ({len(carried)} carried over), expired {expired} configs")
+    config_store_batch.clear()
+
+def query_config_store(column, value, ttl=CONFIG_STORE_TTL):
+    if column == "protocol":
+        query = "SELECT config FROM configs WHERE protocol = ? AND last_seen >= ? ORDER BY last_seen DESC"
+    elif column == "operator":
+        query = """
+            SELECT configs.config FROM config_operators
+            JOIN configs ON configs.fingerprint = config_operators.fingerprint
+            WHERE config_operators.operator = ? AND config_operators.last_seen >= ?
+            ORDER BY config_operators.last_seen DESC
+        """
+    else:
+        raise ValueError(f"Unsupported config store column: {column}")
+    rows = open_config_store().execute(query, (value, time.time() - ttl))
+    return [row[0] for row in rows]
+
+def query_config_store_operators(ttl=CONFIG_STORE_TTL):
+    rows = open_config_store().execute(
+        "SELECT DISTINCT operator FROM config_operators WHERE last_seen >= ? ORDER BY operator",
+        (time.time() - ttl,)
+    )
+    return [row[0] for row in rows]
+
+def load_probe_cache():
+    if not os.path.exists(PROBE_CACHE_FILE):
+        return {}
+    try:
+        with open(PROBE_CACHE_FILE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        logger.info(f"Loaded {len(cache)} probe results from {PROBE_CACHE_FILE}")
+        return cache
     except Exception as e:
-        logger.error(f"[{channel}] Failed to download NPVT from message {message.id}: {str(e)}")
+        logger.error(f"Failed to load probe cache from {PROBE_CACHE_FILE}: {str(e)}")
+        return {}
+
+def probe_entry_ttl(entry, ttl=PROBE_CACHE_TTL, negative_ttl=PROBE_NEGATIVE_TTL):
+    # A single timeout is weak evidence, so failures are re-checked much sooner than successes
+    return ttl if entry["latency"] is not None else min(ttl, negative_ttl)
+
+def save_probe_cache(cache, ttl=PROBE_CACHE_TTL):
+    now = time.time()
+    fresh = {key: entry for key, entry in sorted(cache.items()) if now - entry["checked_at"] < probe_entry_ttl(entry, ttl)}
+    write_output_file(PROBE_CACHE_FILE, json.dumps(fresh, ensure_ascii=False, indent=4))
+    logger.info(f"Saved {len(fresh)} probe results to {PROBE_CACHE_FILE}")
+
+def config_probe_target(config, protocol=None, use_tls=PROBE_TLS):
+    record = parse_config(config, protocol)
+    if not record:
+        return None
+    server_hostname = None
+    if use_tls and record.security == "tls":
+        server_hostname = dict(record.params).get("sni") or record.host
+    return record.host, record.port, server_hostname
+
+def probe_target_key(target):
+    host, port, server_hostname = target
+    key = f"{host}:{port}"
+    return f"{key}/tls:{server_hostname}" if server_hostname else key
+
+async def probe_endpoint(host, port, timeout=PROBE_TIMEOUT, server_hostname=None):
+    ssl_context = None
+    if server_hostname:
+        # Only the handshake is measured; most servers use self-signed or reality certs
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context, server_hostname=server_hostname),
+            timeout
+        )
+    except (OSError, asyncio.TimeoutError, ssl.SSLError, ValueError) as e:
+        logger.debug(f"Probe to {host}:{port} failed: {str(e) or type(e).__name__}")
+        return None
+
+    latency = round((loop.time() - started) * 1000, 1)
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass
+    return latency
+
+async def probe_endpoints(targets, cache=None, concurrency=PROBE_CONCURRENCY, timeout=PROBE_TIMEOUT, ttl=PROBE_CACHE_TTL, known_keys=()):
+    if cache is None:
+        cache = {}
+    now = time.time()
+    results = {}
+    pending = []
+    for target in dict.fromkeys(targets):
+        key = probe_target_key(target)
+        entry = cache.get(key)
+        entry_ttl = known_item_ttl(ttl) if key in known_keys else ttl
+        if entry and now - entry["checked_at"] < probe_entry_ttl(entry, entry_ttl):
+            results[key] = entry["latency"]
+        else:
+            pending.append((key, target))
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def probe_one(key, target):
+        async with semaphore:
+            host, port, server_hostname = target
+            latency = await probe_endpoint(host, port, timeout, server_hostname)
+        results[key] = latency
+        cache[key] = {"latency": latency, "checked_at": time.time()}
+
+    logger.info(f"Probing {len(pending)} endpoints ({len(results)} cached) with up to {concurrency} in flight")
+    await asyncio.gather(*(probe_one(key, target) for key, target in pending))
+    return results
+
+def known_target_keys(targets, known):
+    # An endpoint shared with a new item is probed again
+    new_keys = {probe_target_key(target) for item, target in targets.items() if item not in known}
+    return {probe_target_key(target) for item, target in targets.items() if item in known} - new_keys
+
+async def probe_proxies(proxies, cache=None, known=()):
+    # MTProto proxies are only checked for a TCP connect; the handshake needs the secret
+    targets = {}
+    for proxy in proxies:
+        record = parse_proxy_link(proxy)
+        if record:
+            targets[proxy] = (record.server, record.port, None)
+
+    results = await probe_endpoints(targets.values(), cache, known_keys=known_target_keys(targets, known))
+    return {proxy: results[probe_target_key(target)] for proxy, target in targets.items()}
+
+async def probe_configs(configs, cache=None, known=()):
+    targets = {}
+    for config in configs:
+        target = config_probe_target(config)
+        if target:
+            targets[config] = target
+
+    results = await probe_endpoints(targets.values(), cache, known_keys=known_target_keys(targets, known))
+    return {config: results[probe_target_key(target)] for config, target in targets.items()}
+
+def latency_rank(config, config_latencies):
+    if config not in config_latencies:
+        return (1, 0)
+    latency = config_latencies[config]
+    if latency is None:
+        return (2, 0)
+    return (0, latency)
+
+def rank_configs_by_latency(configs, config_latencies, drop_unreachable=PROBE_DROP_UNREACHABLE):
+    if drop_unreachable:
+        configs = [config for config in configs if config_latencies.get(config, 0) is not None]
+    return sorted(configs, key=lambda config: latency_rank(config, config_latencies))
+
+def load_dns_cache():
+    if not os.path.exists(DNS_CACHE_FILE):
+        return {}
+    try:
+        with open(DNS_CACHE_FILE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        logger.info(f"Loaded {len(cache)} DNS answers from {DNS_CACHE_FILE}")
+        return cache
+    except Exception as e:
+        logger.error(f"Failed to load DNS cache from {DNS_CACHE_FILE}: {str(e)}")
+        return {}
+
+def save_dns_cache(cache):
+    now = time.time()
+    # Answers are kept past their TTL while known hosts may still reuse them
+    known_grace = known_item_ttl(DNS_CACHE_TTL) - DNS_CACHE_TTL
+    fresh = {
+        host: entry for host, entry in sorted(cache.items())
+        if entry["expires_at"] + (known_grace if entry["addresses"] else 0) > now
+    }
+    write_output_file(DNS_CACHE_FILE, json.dumps(fresh, ensure_ascii=False, indent=4))
+    logger.info(f"Saved {len(fresh)} DNS answers to {DNS_CACHE_FILE}")
+
+# A DNS backend is an async callable returning the host's addresses, an empty
+# list when the name does not exist, and raising on transient failures.
+async def system_dns_backend(host):
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        if e.errno in (socket.EAI_NONAME, getattr(socket, "EAI_NODATA", socket.EAI_NONAME)):
+            return []
+        raise
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+async def resolve_hosts(hosts, cache=None, backend=system_dns_backend, concurrency=DNS_CONCURRENCY, timeout=DNS_TIMEOUT, known_hosts=()):
+    if cache is None:
+        cache = {}
+    now = time.time()
+    known_grace = known_item_ttl(DNS_CACHE_TTL) - DNS_CACHE_TTL
+    addresses = {}
+    pending = []
+    for host in dict.fromkeys(hosts):
+        try:
+            addresses[host] = str(ipaddress.ip_address(host.strip("[]")))
+            continue
+        except ValueError:
+            pass
+        entry = cache.get(host)
+        expires_at = entry["expires_at"] if entry else 0
+        if entry and entry["addresses"] and host in known_hosts:
+            expires_at += known_grace
+        if expires_at > now:
+            addresses[host] = entry["addresses"][0] if entry["addresses"] else None
+        else:
+            pending.append(host)
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    failed = 0
+
+    async def resolve_one(host):
+        nonlocal failed
+        async with semaphore:
+            try:
+                answer = await asyncio.wait_for(backend(host), timeout)
+            except (OSError, asyncio.TimeoutError, UnicodeError) as e:
+                # Transient failures are not cached, the next run asks again
+                logger.debug(f"Failed to resolve {host}: {str(e) or type(e).__name__}")
+                failed += 1
+                addresses[host] = None
+                return
+        ttl = DNS_CACHE_TTL if answer else DNS_NEGATIVE_TTL
+        cache[host] = {"addresses": answer, "expires_at": time.time() + ttl}
+        addresses[host] = answer[0] if answer else None
+
+    cached_count = len(addresses)
+    await asyncio.gather(*(resolve_one(host) for host in pending))
+    logger.info(f"Resolved {len(pending)} hostnames ({cached_count} cached or literal, {failed} failed) with up to {concurrency} in flight")
+    return addresses
+
+geoip_readers = None
+
+def open_geoip_readers():
+    global geoip_readers
+    if geoip_readers is not None:
+        return geoip_readers
+
+    geoip_readers = {}
+    if maxminddb is None:
+        logger.warning("maxminddb is not installed, GeoIP enrichment is disabled")
+        return geoip_readers
+    for kind, path in (("country", GEOIP_COUNTRY_DB), ("asn", GEOIP_ASN_DB)):
+        if not os.path.exists(path):
+            logger.info(f"GeoIP {kind} database {path} not found, skipping {kind} shards")
+            continue
+        try:
+            # MODE_AUTO memory-maps the file, through the C extension when it is available
+            geoip_readers[kind] = maxminddb.open_database(path, maxminddb.MODE_AUTO)
+            logger.info(f"Opened GeoIP {kind} database {path}")
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to open GeoIP {kind} database {path}: {str(e)}")
+    return geoip_readers
+
+@lru_cache(maxsize=65536)
+def lookup_geoip(ip):
+    readers = open_geoip_readers()
+    country = None
+    asn = None
+    try:
+        if "country" in readers:
+            record = readers["country"].get(ip) or {}
+            country = (record.get("country") or record.get("registered_country") or {}).get("iso_code")
+        if "asn" in readers:
+            record = readers["asn"].get(ip) or {}
+            asn = record.get("autonomous_system_number")
+    except ValueError as e:
+        logger.debug(f"GeoIP lookup for {ip} failed: {str(e)}")
+    return country, asn
+
+async def enrich_configs_with_geo(all_configs, known=()):
+    country_configs = defaultdict(list)
+    asn_configs = defaultdict(list)
+    if not open_geoip_readers():
+        return country_configs, asn_configs
+
+    config_hosts = {}
+    for protocol, configs in all_configs.items():
+        for config in configs:
+            record = parse_config(config, protocol)
+            if record and record.host:
+                config_hosts[config] = record.host
+
+    dns_cache = load_dns_cache()
+    with run_metrics.timed("dns"):
+        new_hosts = {host for config, host in config_hosts.items() if config not in known}
+        known_hosts = {host for config, host in config_hosts.items() if config in known} - new_hosts
+        addresses = await resolve_hosts(config_hosts.values(), dns_cache, known_hosts=known_hosts)
+    save_dns_cache(dns_cache)
+    placed_count = 0
+    for config, host in config_hosts.items():
+        ip = addresses.get(host)
+        if not ip:
+            continue
+        country, asn = lookup_geoip(ip)
+        if country:
+            country_configs[country.upper()].append(config)
+        if asn:
+            asn_configs[f"AS{asn}"].append(config)
+        if country or asn:
+            placed_count += 1
+
+    logger.info(f"GeoIP placed {placed_count} of {len(config_hosts)} configs into {len(country_configs)} countries and {len(asn_configs)} ASNs")
+    return country_configs, asn_configs
+
+output_manifest = None
+
+def load_output_manifest():
+    global output_manifest
+    if output_manifest is not None:
+        return output_manifest
+
+    output_manifest = {}
+    if os.path.exists(OUTPUT_MANIFEST_FILE):
+        try:
+            with open(OUTPUT_MANIFEST_FILE, "r", encoding="utf-8") as f:
+                output_manifest = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load output manifest from {OUTPUT_MANIFEST_FILE}: {str(e)}")
+    return output_manifest
+
+def save_output_manifest():
+    content = json.dumps(dict(sorted(load_output_manifest().items())), ensure_ascii=False, indent=4)
+    if os.path.exists(OUTPUT_MANIFEST_FILE):
+        with open(OUTPUT_MANIFEST_FILE, "r", encoding="utf-8") as f:
+            if f.read() == content:
+                return
+    write_output_file(OUTPUT_MANIFEST_FILE, content, track=False)
+    logger.info(f"Saved output manifest to {OUTPUT_MANIFEST_FILE}")
+
+def write_file_atomic(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def subscription_variant_paths(path):
+    root, _ = os.path.splitext(path)
+    return f"{root}_base64.txt", f"{path}.gz"
+
+def write_output_file(path, content, subscription=None, track=True):
+    data = content.encode("utf-8")
+    variant_paths = subscription_variant_paths(path) if subscription is not None else ()
+    content_hash = hashlib.sha256(data).hexdigest()
+    manifest = load_output_manifest()
+
+    if track and manifest.get(path) == content_hash and all(os.path.exists(p) for p in (path,) + variant_paths):
+        logger.info(f"{path} unchanged, skipped write")
+        return False
+
+    with run_metrics.timed("write"):
+        write_file_atomic(path, data)
+    run_metrics.add_bytes("write", len(data))
+    if subscription is not None:
+        base64_path, gzip_path = variant_paths
+        write_file_atomic(base64_path, base64.b64encode("\n".join(subscription).encode("utf-8")) + b"\n")
+        # mtime=0 keeps the gzip bytes identical for identical content
+        write_file_atomic(gzip_path, gzip.compress(data, compresslevel=9, mtime=0))
+    if track:
+        manifest[path] = content_hash
+    return True
+
+def render_lines(items, placeholder):
+    if items:
+        return "".join(f"{item}\n" for item in items)
+    return f"{placeholder}\n"
 
-    return None
-    
 def save_configs(configs, protocol):
     output_file = os.path.join(OUTPUT_DIR, f"{protocol}.txt")
     logger.info(f"Saving configs to {output_file}")
-    with open(output_file, "w", encoding="utf-8") as f:
-        if configs:
-            for config in configs:
-                f.write(config + "\n")
-            logger.info(f"Saved {len(configs)} {protocol} configs to {output_file}")
-        else:
-            f.write("No configs found for this protocol.\n")
-            logger.info(f"No {protocol} configs found, wrote placeholder to {output_file}")
+    write_output_file(output_file, render_lines(configs, "No configs found for this protocol."), configs)
+    if configs:
+        logger.info(f"Saved {len(configs)} {protocol} configs to {output_file}")
+    else:
+        logger.info(f"No {protocol} configs found, wrote placeholder to {output_file}")
 
 def save_operator_configs(operator_configs):
     for op, configs in operator_configs.items():
         output_file = os.path.join(OUTPUT_DIR, f"{op}.txt")
         logger.info(f"Saving operator configs to {output_file}")
-        with open(output_file, "w", encoding="utf-8") as f:
-            if configs:
-                for config in configs:
-                    f.write(config + "\n")
-                logger.info(f"Saved {len(configs)} configs for {op} to {output_file}")
-            else:
-                f.write(f"No configs found for {op}.\n")
-                logger.info(f"No configs found for {op}, wrote placeholder to {output_file}")
+        write_output_file(output_file, render_lines(configs, f"No configs found for {op}."), configs)
+        if configs:
+            logger.info(f"Saved {len(configs)} configs for {op} to {output_file}")
+        else:
+            logger.info(f"No configs found for {op}, wrote placeholder to {output_file}")
 
 def save_proxies(proxies):
     output_file = os.path.join(OUTPUT_DIR, f"proxies.txt")
     logger.info(f"Saving proxies to {output_file}")
-    with open(output_file, "w", encoding="utf-8") as f:
-        if proxies:
-            for proxy in proxies:
-                f.write(f"{proxy}\n")
-            logger.info(f"Saved {len(proxies)} proxies to {output_file}")
-        else:
-            f.write("No proxies found.\n")
-            logger.info("No proxies found, wrote placeholder to proxies.txt")
+    write_output_file(output_file, render_lines(proxies, "No proxies found."), proxies)
+    if proxies:
+        logger.info(f"Saved {len(proxies)} proxies to {output_file}")
+    else:
+        logger.info("No proxies found, wrote placeholder to proxies.txt")
+
+def save_config_shards(directory, shards):
+    os.makedirs(directory, exist_ok=True)
+    for name, configs in shards.items():
+        write_output_file(os.path.join(directory, f"{name}.txt"), render_lines(configs, ""))
+    # Shards that got no configs this run are removed rather than left stale
+    manifest = load_output_manifest()
+    for file_name in os.listdir(directory):
+        if file_name.endswith(".txt") and file_name[:-4] not in shards:
+            path = os.path.join(directory, file_name)
+            os.remove(path)
+            manifest.pop(path, None)
+    logger.info(f"Saved {len(shards)} shards to {directory}")
+
+def clear_config_shards(directory):
+    # Without a database the previous run's shards would stay published with stale contents
+    if not os.path.isdir(directory):
+        return
+    save_config_shards(directory, {})
+    if not os.listdir(directory):
+        os.rmdir(directory)
 
 def save_invalid_channels(invalid_channels):
     logger.info(f"Saving invalid channels to {INVALID_CHANNELS_FILE}")
-    with open(INVALID_CHANNELS_FILE, "w", encoding="utf-8") as f:
-        if invalid_channels:
-            for channel in invalid_channels:
-                f.write(f"{channel}\n")
-            logger.info(f"Saved {len(invalid_channels)} invalid channels to {INVALID_CHANNELS_FILE}")
-        else:
-            f.write("No invalid channels found.\n")
-            logger.info(f"No invalid channels found, wrote placeholder to {INVALID_CHANNELS_FILE}")
+    write_output_file(INVALID_CHANNELS_FILE, render_lines(invalid_channels, "No invalid channels found."))
+    if invalid_channels:
+        logger.info(f"Saved {len(invalid_channels)} invalid channels to {INVALID_CHANNELS_FILE}")
+    else:
+        logger.info(f"No invalid channels found, wrote placeholder to {INVALID_CHANNELS_FILE}")
 
 def save_channel_stats(stats):
     logger.info(f"Saving channel stats to {STATS_FILE}")
     stats_list = [{"channel": channel, **data} for channel, data in stats.items()]
     sorted_stats = sorted(stats_list, key=lambda x: x["score"], reverse=True)
-    with open(STATS_FILE, "w", encoding="utf-8") as f:
-        json.dump(sorted_stats, f, ensure_ascii=False, indent=4)
+    write_output_file(STATS_FILE, json.dumps(sorted_stats, ensure_ascii=False, indent=4))
     logger.info(f"Saved channel stats to {STATS_FILE}")
 
 def format_proxies_in_rows(proxies, per_row=4):
@@ -333,7 +2124,7 @@ def format_proxies_for_caption(proxies, max_count=8):
         return None
 
     selected = list(proxies[:max_count])
-    links = [f"[Proxy {i+1}]({item['proxy']})" for i, item in enumerate(selected)]
+    links = [f"[Proxy {i+1}]({item.proxy})" for i, item in enumerate(selected)]
 
     first_row = " | ".join(links[:4])
     second_row = " | ".join(links[4:8])
@@ -342,7 +2133,7 @@ def format_proxies_for_caption(proxies, max_count=8):
         return f"{first_row}\n{second_row}"
 
     return first_row
-    
+
 def build_sources_text(config_source, npvt_source, proxy_sources):
     proxies_sources_text = ", ".join([format_channel_source(src) for src in proxy_sources]) if proxy_sources else "N/A"
     return (
@@ -375,7 +2166,7 @@ def build_npvt_caption(proxies_text, index, total, config_source, npvt_source, p
         f"🔗 **Latest Proxies**\n{proxies_text}\n\n"
         if proxies_text else ""
     )
-    
+
     caption = (
         f"🧩 **NPVT + Config Pack** ({index}/{total})\n\n"
         f"⚙️ **Random {config_type} Config**\n"
@@ -442,7 +2233,7 @@ def build_npvt_caption(proxies_text, index, total, config_source, npvt_source, p
 
 #     return selected[:required_count]
 
-def select_post_payloads(last_channels, channel_recent_configs, channel_recent_npvt, best_channel, required_count):
+def select_post_payloads(last_channels, channel_recent_configs, channel_recent_npvt, best_channel, required_count, config_latencies=None):
     all_channels = list(dict.fromkeys(last_channels + ([best_channel] if best_channel else [])))
 
     all_configs = []
@@ -450,6 +2241,11 @@ def select_post_payloads(last_channels, channel_recent_configs, channel_recent_n
         items = channel_recent_configs.get(channel, [])
         all_configs.extend(reversed(items))
 
+    if config_latencies:
+        if PROBE_DROP_UNREACHABLE:
+            all_configs = [item for item in all_configs if config_latencies.get(item.config, 0) is not None]
+        all_configs.sort(key=lambda item: latency_rank(item.config, config_latencies))
+
     all_npvts = []
     for channel in all_channels:
         items = channel_recent_npvt.get(channel, [])
@@ -463,23 +2259,38 @@ def select_post_payloads(last_channels, channel_recent_configs, channel_recent_n
         config_item = all_configs[i % len(all_configs)]
         npvt_item = all_npvts[i % len(all_npvts)]
         selected.append({
-            "channel": config_item["source"],
+            "channel": config_item.source,
             "config_item": config_item,
             "npvt_item": npvt_item
         })
 
     return selected
 
-def select_proxy_items_for_post(random_channels, channel_recent_proxies, best_channel, required_count=8):
+def select_proxy_items_for_post(random_channels, channel_recent_proxies, best_channel, required_count=8, proxy_latencies=None):
     selected = []
+    seen = set()
+
+    def extend(items):
+        for item in items:
+            key = proxy_fingerprint(item.proxy)
+            if key in seen:
+                continue
+            if proxy_latencies and PROXY_DROP_UNREACHABLE and proxy_latencies.get(item.proxy, 0) is None:
+                continue
+            seen.add(key)
+            selected.append(item)
 
     for channel in random_channels:
-        selected.extend(channel_recent_proxies.get(channel, []))
+        extend(channel_recent_proxies.get(channel, []))
         if len(selected) >= required_count:
             break
 
     if len(selected) < required_count and best_channel:
-        selected.extend(channel_recent_proxies.get(best_channel, []))
+        extend(channel_recent_proxies.get(best_channel, []))
+
+    if proxy_latencies:
+        # Stable sort, so proxies without a probe result keep their channel order
+        selected.sort(key=lambda item: latency_rank(item.proxy, proxy_latencies))
 
     return selected[:required_count]
 
@@ -592,11 +2403,82 @@ def extract_invite_hash(channel):
 
     return None
 
+entity_cache = None
+
+def load_entity_cache():
+    global entity_cache
+    if entity_cache is not None:
+        return entity_cache
+
+    entity_cache = {}
+    if os.path.exists(ENTITY_CACHE_FILE):
+        try:
+            with open(ENTITY_CACHE_FILE, "r", encoding="utf-8") as f:
+                entity_cache = json.load(f)
+            logger.info(f"Loaded {len(entity_cache)} cached entities from {ENTITY_CACHE_FILE}")
+        except Exception as e:
+            logger.error(f"Failed to load entity cache from {ENTITY_CACHE_FILE}: {str(e)}")
+    return entity_cache
+
+def save_entity_cache():
+    cache = load_entity_cache()
+    write_output_file(ENTITY_CACHE_FILE, json.dumps(dict(sorted(cache.items())), ensure_ascii=False, indent=4))
+    logger.info(f"Saved {len(cache)} cached entities to {ENTITY_CACHE_FILE}")
+
+def entity_to_cache_entry(entity):
+    try:
+        peer = utils.get_input_peer(entity)
+    except Exception:
+        return None
+    if isinstance(peer, InputPeerChannel):
+        return {"type": "channel", "id": peer.channel_id, "access_hash": peer.access_hash}
+    if isinstance(peer, InputPeerUser):
+        return {"type": "user", "id": peer.user_id, "access_hash": peer.access_hash}
+    if isinstance(peer, InputPeerChat):
+        return {"type": "chat", "id": peer.chat_id}
+    return None
+
+def cache_entry_to_input_peer(entry):
+    if entry["type"] == "channel":
+        return InputPeerChannel(entry["id"], entry["access_hash"])
+    if entry["type"] == "user":
+        return InputPeerUser(entry["id"], entry["access_hash"])
+    if entry["type"] == "chat":
+        return InputPeerChat(entry["id"])
+    return None
+
+def entity_cache_key(client, channel):
+    # Access hashes are only valid for the account that resolved them
+    label = client_account_label(client)
+    return f"{label}:{channel}" if label else str(channel)
+
+def invalidate_cached_entity(channel, client=None):
+    removed = load_entity_cache().pop(entity_cache_key(client, channel), None)
+    if removed:
+        logger.info(f"Invalidated cached entity for {channel}")
+    return removed is not None
+
 async def resolve_channel_target(client, channel):
+    cache = load_entity_cache()
+    key = entity_cache_key(client, channel)
+    entry = cache.get(key)
+    if entry:
+        peer = cache_entry_to_input_peer(entry)
+        if peer is not None:
+            logger.debug(f"Resolved {channel} from entity cache")
+            return peer
+
+    entity = await resolve_channel_target_uncached(client, channel)
+    entry = entity_to_cache_entry(entity)
+    if entry:
+        cache[key] = entry
+    return entity
+
+async def resolve_channel_target_uncached(client, channel):
     invite_hash = extract_invite_hash(channel)
     if invite_hash:
         try:
-            import_result = await client(ImportChatInviteRequest(invite_hash))
+            import_result = await client_scheduler(client).call("resolve", client, ImportChatInviteRequest(invite_hash))
             chats = getattr(import_result, "chats", None)
             if chats:
                 return chats[0]
@@ -604,7 +2486,7 @@ async def resolve_channel_target(client, channel):
             logger.info(f"Invite import skipped/failed for {channel}: {str(e)}")
 
         try:
-            invite_info = await client(CheckChatInviteRequest(invite_hash))
+            invite_info = await client_scheduler(client).call("resolve", client, CheckChatInviteRequest(invite_hash))
             if hasattr(invite_info, "chat") and invite_info.chat:
                 return invite_info.chat
         except Exception as e:
@@ -614,7 +2496,201 @@ async def resolve_channel_target(client, channel):
         raise ValueError(f"Cannot resolve private invite link: {channel}")
 
     parsed = parse_channel_identifier(channel)
-    return await client.get_entity(parsed)
+    return await client_scheduler(client).call("resolve", client.get_entity, parsed)
+
+# Fixed-size seen-set for discovery candidates. A false positive only means a
+# candidate is never probed; a probed candidate is never probed again.
+class BloomFilter:
+    def __init__(self, capacity, error_rate, bits=None):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        byte_count = (self.size + 7) // 8
+        self.bits = bytearray(bits) if bits is not None and len(bits) == byte_count else bytearray(byte_count)
+
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+def load_discovery_seen():
+    bits = None
+    if os.path.exists(DISCOVERY_SEEN_FILE):
+        try:
+            with open(DISCOVERY_SEEN_FILE, "rb") as f:
+                bits = f.read()
+        except Exception as e:
+            logger.error(f"Failed to load discovery seen-set from {DISCOVERY_SEEN_FILE}: {str(e)}")
+    seen = BloomFilter(DISCOVERY_SEEN_CAPACITY, DISCOVERY_SEEN_ERROR_RATE, bits)
+    if bits is not None and bytes(seen.bits) != bits:
+        logger.warning(f"Discovery seen-set {DISCOVERY_SEEN_FILE} does not match the configured capacity, starting a new one")
+    return seen
+
+def save_discovery_seen(seen):
+    write_file_atomic(DISCOVERY_SEEN_FILE, bytes(seen.bits))
+    logger.info(f"Saved discovery seen-set ({len(seen.bits)} bytes) to {DISCOVERY_SEEN_FILE}")
+
+def load_discovery_candidates():
+    if not os.path.exists(DISCOVERY_CANDIDATES_FILE):
+        return {}
+    try:
+        with open(DISCOVERY_CANDIDATES_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Failed to load discovery candidates from {DISCOVERY_CANDIDATES_FILE}: {str(e)}")
+        return {}
+
+def save_discovery_candidates(candidates):
+    write_output_file(DISCOVERY_CANDIDATES_FILE, json.dumps(candidates, ensure_ascii=False, indent=4))
+    logger.info(f"Saved {len(candidates)} discovery candidates to {DISCOVERY_CANDIDATES_FILE}")
+
+async def count_candidate_configs(client, entity, limit=DISCOVERY_PROBE_MESSAGES):
+    min_date = datetime.now().date() - timedelta(days=1)
+    configs_found = 0
+    async for message in client.iter_messages(entity, limit=limit):
+        if not message.date or message.date.date() < min_date:
+            break
+        extraction = extract_message(message)
+        configs_found += sum(len(matches) for matches in extraction["configs"].values())
+    return configs_found
+
+async def probe_channel_candidate(client, candidate):
+    entity = await resolve_channel_target_uncached(client, candidate)
+    if not (getattr(entity, "broadcast", False) or getattr(entity, "megagroup", False)):
+        logger.info(f"Discovery candidate {candidate} is not a channel, skipped")
+        return 0
+    return await client_scheduler(client).call("history", count_candidate_configs, client, entity)
+
+async def discover_channels(client, channels, mentions=None):
+    if mentions is None:
+        mentions = discovery_mentions
+    seen = load_discovery_seen()
+    candidates = load_discovery_candidates()
+    known = {str(ch).lower() for ch in channels}
+    now = datetime.now().isoformat()
+
+    for candidate, count in mentions.items():
+        key = candidate.lower()
+        if key in known or key in seen:
+            continue
+        entry = candidates.setdefault(key, {"channel": candidate, "mentions": 0, "first_seen": now})
+        entry["mentions"] += count
+        entry["last_seen"] = now
+    mentions.clear()
+
+    # The pending list is bounded; the least mentioned candidates are forgotten first
+    ranked = sorted(candidates.items(), key=lambda item: (-item[1]["mentions"], item[1]["first_seen"]))
+    candidates = dict(ranked[:DISCOVERY_MAX_PENDING])
+
+    promoted = []
+    probed_count = 0
+    for key, entry in ranked[:DISCOVERY_PROBES_PER_RUN]:
+        candidate = entry["channel"]
+        try:
+            configs_found = await probe_channel_candidate(client, candidate)
+        except FloodWaitError as e:
+            logger.warning(f"Discovery stopped by a flood wait of {e.seconds}s, {candidate} stays pending")
+            break
+        except Exception as e:
+            logger.info(f"Discovery candidate {candidate} could not be probed: {str(e)}")
+            configs_found = 0
+
+        seen.add(key)
+        probed_count += 1
+        candidates.pop(key, None)
+        logger.info(f"Discovery probed {candidate} ({entry['mentions']} mentions): {configs_found} configs in the last day")
+        if configs_found >= DISCOVERY_MIN_CONFIGS:
+            promoted.append(candidate)
+            print(f"🔭 Promoted {candidate} to the source list ({configs_found} configs in the last day)")
+
+    if promoted:
+        update_channels(list(channels) + promoted)
+    if probed_count:
+        save_discovery_seen(seen)
+    save_discovery_candidates(candidates)
+    return promoted
+
+def load_account_credentials():
+    sessions = list(dict.fromkeys(([SESSION_STRING] if SESSION_STRING else []) + SESSION_STRINGS))
+    credentials = []
+    for index, session in enumerate(sessions):
+        api_id = API_IDS[index] if index < len(API_IDS) else API_ID
+        api_hash = API_HASHES[index] if index < len(API_HASHES) else API_HASH
+        credentials.append((session, api_id, api_hash))
+    return credentials
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "big")
+
+def build_account_ring(clients, replicas=ACCOUNT_RING_REPLICAS):
+    points = sorted(
+        (ring_hash(f"{client_account_label(client) or index}#{replica}"), index)
+        for index, client in enumerate(clients)
+        for replica in range(replicas)
+    )
+    return [point for point, _ in points], [clients[index] for _, index in points]
+
+def ring_lookup(ring, channel):
+    keys, clients = ring
+    return clients[bisect.bisect(keys, ring_hash(channel)) % len(keys)]
+
+# Passes channel results through to the aggregator, holding back the ones an
+# account-level failure (flood wait, revoked session) should retry elsewhere.
+class ShardCollector:
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self.failed = {}
+
+    def add(self, channel, result):
+        if isinstance(result, (FloodWaitError, UnauthorizedError)):
+            self.failed[channel] = result
+        else:
+            self.aggregator.add(channel, result)
+
+async def fetch_all_channels_sharded(clients, channels, aggregator, cursors=None, history=None, max_concurrency=MAX_CONCURRENT_CHANNELS):
+    available = list(clients)
+    pending = list(channels)
+    failures = {}
+
+    while pending and available:
+        # Consistent hashing keeps each channel on the same account (and its cached entities)
+        # and only moves a failed account's channels when it drops out of the ring
+        ring = build_account_ring(available)
+        shards = defaultdict(list)
+        for channel in pending:
+            shards[ring_lookup(ring, channel)].append(channel)
+
+        async def run_shard(client, shard_channels):
+            collector = ShardCollector(aggregator)
+            await fetch_all_channels(client, shard_channels, max_concurrency, cursors, aggregator=collector, history=history)
+            return client, collector
+
+        if len(available) > 1:
+            logger.info(f"Fetching {len(pending)} channels across {len(shards)} accounts")
+        shard_results = await asyncio.gather(*(run_shard(client, shard_channels) for client, shard_channels in shards.items()))
+
+        pending = []
+        for client, collector in shard_results:
+            if not collector.failed:
+                continue
+            available.remove(client)
+            failures.update(collector.failed)
+            pending.extend(collector.failed)
+            label = client_account_label(client) or "default"
+            reason = type(next(iter(collector.failed.values()))).__name__
+            logger.warning(f"Account {label} failed with {reason}, moving {len(collector.failed)} channels to {len(available)} remaining accounts")
+            if available:
+                print(f"🔀 Account {label} hit {reason}, failing over {len(collector.failed)} channels")
+
+    for channel in pending:
+        aggregator.add(channel, failures[channel])
 
 async def send_message_to_destination(client, destination, message, parse_mode="markdown", reply_to=None):
     try:
@@ -623,15 +2699,31 @@ async def send_message_to_destination(client, destination, message, parse_mode="
         else:
             dest_identifier = destination
 
-        await client.send_message(dest_identifier, message, parse_mode=parse_mode, reply_to=reply_to)
+        await client_scheduler(client).call("send", client.send_message, dest_identifier, message, parse_mode=parse_mode, reply_to=reply_to)
         logger.info(f"Successfully sent message to {destination}")
         print(f"✅ Message posted to {destination}")
         return True
     except Exception as e:
+        if isinstance(e, (ChannelInvalidError, PeerIdInvalidError)) and isinstance(destination, str):
+            invalidate_cached_entity(destination, client)
         logger.error(f"Failed to send message to {destination}: {str(e)}")
         print(f"❌ Failed to send message to {destination}: {str(e)}")
         return False
 
+uploaded_media = {}
+
+def file_content_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def remember_uploaded_media(file_hash, sent_message):
+    media = getattr(sent_message, "media", None)
+    if media is not None:
+        uploaded_media[file_hash] = media
+
 async def send_file_to_destination(client, destination, file_path, caption, parse_mode="markdown"):
     try:
         if isinstance(destination, str):
@@ -639,16 +2731,54 @@ async def send_file_to_destination(client, destination, file_path, caption, pars
         else:
             dest_identifier = destination
 
-        sent_message = await client.send_file(dest_identifier, file_path, caption=caption, parse_mode=parse_mode)
+        file_hash = file_content_hash(file_path)
+        media = uploaded_media.get(file_hash)
+        if media is not None:
+            logger.info(f"Reusing uploaded media for {file_path}")
+        else:
+            run_metrics.add_bytes("post", os.path.getsize(file_path))
+
+        sent_message = await client_scheduler(client).call("send", client.send_file, dest_identifier, media or file_path, caption=caption, parse_mode=parse_mode)
+        remember_uploaded_media(file_hash, sent_message)
         logger.info(f"Successfully sent file to {destination}: {file_path}")
         print(f"✅ File posted to {destination}: {os.path.basename(file_path)}")
         return sent_message
     except Exception as e:
+        if isinstance(e, (ChannelInvalidError, PeerIdInvalidError)) and isinstance(destination, str):
+            invalidate_cached_entity(destination, client)
         logger.error(f"Failed to send file to {destination}: {str(e)}")
         print(f"❌ Failed to send file to {destination}: {str(e)}")
         return None
 
-async def post_config_and_proxies_to_channel(client, channel_stats, valid_channels, channel_recent_configs, channel_recent_npvt, channel_recent_proxies):
+async def send_album_to_destination(client, destination, file_paths, captions, parse_mode="markdown"):
+    try:
+        if isinstance(destination, str):
+            dest_identifier = await resolve_channel_target(client, destination)
+        else:
+            dest_identifier = destination
+
+        file_hashes = [file_content_hash(file_path) for file_path in file_paths]
+        for file_hash, file_path in zip(file_hashes, file_paths):
+            # Each distinct file is uploaded once even if it appears several times in the album
+            if file_hash not in uploaded_media:
+                run_metrics.add_bytes("post", os.path.getsize(file_path))
+                uploaded_media[file_hash] = await client_scheduler(client).call("send", client.upload_file, file_path)
+
+        files = [uploaded_media[file_hash] for file_hash in file_hashes]
+        sent_messages = await client_scheduler(client).call("send", client.send_file, dest_identifier, files, caption=captions, parse_mode=parse_mode)
+        for file_hash, sent_message in zip(file_hashes, sent_messages or []):
+            remember_uploaded_media(file_hash, sent_message)
+        logger.info(f"Successfully sent album of {len(files)} files to {destination}")
+        print(f"✅ Album of {len(files)} files posted to {destination}")
+        return sent_messages
+    except Exception as e:
+        if isinstance(e, (ChannelInvalidError, PeerIdInvalidError)) and isinstance(destination, str):
+            invalidate_cached_entity(destination, client)
+        logger.error(f"Failed to send album to {destination}: {str(e)}")
+        print(f"❌ Failed to send album to {destination}: {str(e)}")
+        return None
+
+async def post_config_and_proxies_to_channel(client, channel_stats, valid_channels, channel_recent_configs, channel_recent_npvt, channel_recent_proxies, config_latencies=None, proxy_latencies=None):
     POST_COUNT = 5
 
     if not valid_channels:
@@ -664,7 +2794,8 @@ async def post_config_and_proxies_to_channel(client, channel_stats, valid_channe
         channel_recent_configs,
         channel_recent_npvt,
         best_channel,
-        POST_COUNT
+        POST_COUNT,
+        config_latencies
     )
 
     random.shuffle(selected_payloads)
@@ -678,7 +2809,8 @@ async def post_config_and_proxies_to_channel(client, channel_stats, valid_channe
         random_channels,
         channel_recent_proxies,
         best_channel,
-        required_count=8
+        required_count=8,
+        proxy_latencies=proxy_latencies
     )
 
 
@@ -687,23 +2819,25 @@ async def post_config_and_proxies_to_channel(client, channel_stats, valid_channe
         print("⚠️  No proxy items available — posting without proxies")
         proxy_sources = []
     else:
-        proxy_sources = list(dict.fromkeys([item["source"] for item in selected_proxy_items]))
+        proxy_sources = list(dict.fromkeys([item.source for item in selected_proxy_items]))
 
     try:
-        destination_entity = await resolve_channel_target(client, DESTINATION_CHANNEL)
+        # Resolved up front to fail early; later sends reuse the entity cache
+        await resolve_channel_target(client, DESTINATION_CHANNEL)
     except Exception as e:
         logger.error(f"Failed to resolve destination channel {DESTINATION_CHANNEL}: {str(e)}")
         print(f"❌ Failed to resolve destination channel: {str(e)}")
         return
 
+    posts = []
     for i, payload in enumerate(selected_payloads, start=1):
         source_channel = payload["channel"]
         config_item = payload["config_item"]
         npvt_item = payload["npvt_item"]
 
-        config_type = config_item["protocol"]
-        selected_config = config_item["config"]
-        config_source = config_item["source"]
+        config_type = config_item.protocol
+        selected_config = config_item.config
+        config_source = config_item.source
         npvt_file = npvt_item["file_path"]
         npvt_source = npvt_item["source"]
         npvt_password = npvt_item.get("password", None)
@@ -723,10 +2857,32 @@ async def post_config_and_proxies_to_channel(client, channel_stats, valid_channe
             selected_config,
             npvt_password
         )
+        posts.append((i, config_type, npvt_file, caption))
+
+    if POST_AS_ALBUM:
+        remaining = []
+        for start in range(0, len(posts), ALBUM_MAX_ITEMS):
+            chunk = posts[start:start + ALBUM_MAX_ITEMS]
+            sent_messages = await send_album_to_destination(
+                client,
+                DESTINATION_CHANNEL,
+                [npvt_file for _, _, npvt_file, _ in chunk],
+                [caption for _, _, _, caption in chunk],
+                parse_mode="markdown"
+            )
+            if sent_messages:
+                logger.info(f"Posted {len(chunk)} NPVT + config payloads as an album")
+                print(f"📤 Posted album of {len(chunk)} NPVT + config payloads")
+            else:
+                remaining.extend(chunk)
+        if remaining:
+            logger.warning(f"Album posting failed, posting {len(remaining)} payloads one by one")
+        posts = remaining
 
+    for i, config_type, npvt_file, caption in posts:
         sent_file_message = await send_file_to_destination(
             client,
-            destination_entity,
+            DESTINATION_CHANNEL,
             npvt_file,
             caption,
             parse_mode="markdown"
@@ -739,147 +2895,778 @@ async def post_config_and_proxies_to_channel(client, channel_stats, valid_channe
         else:
             logger.error(f"Failed to post NPVT + config ({i}/{POST_COUNT})")
 
-        await asyncio.sleep(4)
 
+def empty_channel_stats(error):
+    return {
+        "vless_count": 0,
+        "vmess_count": 0,
+        "shadowsocks_count": 0,
+        "trojan_count": 0,
+        "proxy_count": 0,
+        "total_configs": 0,
+        "score": 0,
+        "error": error
+    }
+
+# Folds per-channel results into deduplicated output as they arrive. Each
+# config keeps the (channel index, position) of its first sighting, so the
+# final order matches concatenating channels in file order and deduplicating,
+# whatever order the channels complete in. Timelines are kept whole, since
+# the post selectors rank across each channel's full timeline.
+class ResultAggregator:
+    def __init__(self, channels):
+        self.order = {channel: index for index, channel in enumerate(channels)}
+        self.configs = {"vless": {}, "vmess": {}, "shadowsocks": {}, "trojan": {}}
+        self.operator_configs = defaultdict(dict)
+        self.proxies = {}
+        self.npvt_files = {}
+        self.strings = {}
+        self.recent_configs = {}
+        self.recent_npvt = {}
+        self.recent_proxies = {}
+        self.valid_channels = set()
+        self.throttled_channels = set()
+        self.invalid_channels = set()
+        self.failures = {}
+        self.channel_stats = {}
+
+    def intern(self, value):
+        return self.strings.setdefault(value, value)
+
+    @staticmethod
+    def insert(table, key, position, value):
+        current = table.get(key)
+        if current is None or position < current[0]:
+            table[key] = (position, value)
+
+    def add(self, channel, result):
+        index = self.order.get(channel, len(self.order))
+        try:
+            if isinstance(result, FloodWaitError):
+                print(f"⏳ [{channel}] Throttled by Telegram, keeping it for the next run")
+                logger.warning(f"Channel {channel} skipped after flood wait of {result.seconds}s")
+                self.throttled_channels.add(channel)
+                self.failures[channel] = result
+                self.channel_stats[channel] = empty_channel_stats(f"Flood wait of {result.seconds}s")
+                return
+            if isinstance(result, Exception):
+                raise result
+            channel_configs, channel_config_timeline, channel_operator_configs, channel_proxies, channel_npvt_files, channel_proxy_timeline, is_valid = result
+            if not is_valid:
+                print(f"⚠️  [{channel}] Invalid or inaccessible")
+                self.invalid_channels.add(channel)
+                self.failures[channel] = result
+                self.channel_stats[channel] = empty_channel_stats("Channel does not exist or is inaccessible")
+                return
+
+            self.valid_channels.add(channel)
+            total_configs = sum(len(configs) for configs in channel_configs.values())
+            proxy_count = len(channel_proxies)
+            score = total_configs + proxy_count
+            print(f"   └─ [{channel}] vless: {len(channel_configs['vless'])} | vmess: {len(channel_configs['vmess'])} | ss: {len(channel_configs['shadowsocks'])} | trojan: {len(channel_configs['trojan'])} | proxies: {proxy_count} | npvt: {len(channel_npvt_files)}")
+
+            self.channel_stats[channel] = {
+                "vless_count": len(channel_configs["vless"]),
+                "vmess_count": len(channel_configs["vmess"]),
+                "shadowsocks_count": len(channel_configs["shadowsocks"]),
+                "trojan_count": len(channel_configs["trojan"]),
+                "proxy_count": proxy_count,
+                "total_configs": total_configs,
+                "score": score
+            }
+
+            for protocol, configs in channel_configs.items():
+                table = self.configs[protocol]
+                for position, config in enumerate(configs):
+                    self.insert(table, config_fingerprint(config, protocol), (index, position), self.intern(config))
+            for op, configs in channel_operator_configs.items():
+                table = self.operator_configs[op]
+                for position, config in enumerate(configs):
+                    self.insert(table, config_fingerprint(config), (index, position), self.intern(config))
+            for position, proxy in enumerate(channel_proxies):
+                # Records carried over from older runs may still hold un-normalized links
+                record = parse_proxy_link(proxy)
+                if record:
+                    proxy = canonical_proxy_link(record)
+                self.insert(self.proxies, proxy_fingerprint(proxy), (index, position), self.intern(proxy))
+            for position, item in enumerate(channel_npvt_files):
+                self.insert(self.npvt_files, item["file_path"], (index, position), item["file_path"])
+
+            self.recent_configs[channel] = [
+                TimelineItem(item.protocol, self.intern(item.config), item.source)
+                for item in channel_config_timeline
+            ]
+            self.recent_npvt[channel] = channel_npvt_files
+            self.recent_proxies[channel] = [
+                ProxyItem(self.intern(item.proxy), item.source)
+                for item in channel_proxy_timeline
+            ]
+        except Exception as e:
+            print(f"❌ [{channel}] Exception: {str(e)}")
+            self.invalid_channels.add(channel)
+            self.failures[channel] = e
+            self.channel_stats[channel] = empty_channel_stats(str(e))
+            logger.error(f"Channel {channel} is invalid: {str(e)}")
+
+    def ordered(self, channels):
+        return sorted(channels, key=lambda channel: self.order.get(channel, len(self.order)))
+
+    def collection(self):
+        def values(table):
+            return [value for _, value in sorted(table.values(), key=lambda entry: entry[0])]
+
+        return {
+            "configs": {protocol: values(table) for protocol, table in self.configs.items()},
+            "operator_configs": defaultdict(list, {op: values(table) for op, table in self.operator_configs.items()}),
+            "proxies": values(self.proxies),
+            "npvt_files": values(self.npvt_files),
+            "recent_configs": self.recent_configs,
+            "recent_npvt": self.recent_npvt,
+            "recent_proxies": self.recent_proxies,
+            "valid_channels": self.ordered(self.valid_channels),
+            "throttled_channels": self.ordered(self.throttled_channels),
+            "invalid_channels": self.ordered(self.invalid_channels),
+            "failures": self.failures,
+            "channel_stats": {channel: self.channel_stats[channel] for channel in self.ordered(self.channel_stats)},
+            "config_latencies": {},
+            "proxy_latencies": {}
+        }
+
+ResponseBody = namedtuple("ResponseBody", ["data", "gzip_data", "etag", "gzip_etag"])
+
+HTTP_REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    503: "Service Unavailable"
+}
+
+def build_response_body(data):
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    # The gzip representation has different bytes, so it needs its own strong ETag
+    return ResponseBody(data, gzip.compress(data, compresslevel=9, mtime=0), f'"{digest}"', f'"{digest}-gzip"')
+
+def render_subscription_body(items, placeholder, output_format="plain"):
+    if output_format == "base64":
+        # Same bytes as the *_base64.txt files
+        return build_response_body(base64.b64encode("\n".join(items).encode("utf-8")) + b"\n")
+    return build_response_body(render_lines(items, placeholder).encode("utf-8"))
+
+def config_protocol(config):
+    scheme = config.split("://", 1)[0].lower()
+    return "shadowsocks" if scheme == "ss" else scheme
+
+# Immutable view of one collection pass. Every list the publisher writes to
+# Config/ is rendered and gzipped up front; filtered views come from the
+# (protocol, operator) index and are rendered once per distinct query.
+class SubscriptionSnapshot:
+    def __init__(self, configs, operator_configs, proxies):
+        lists = {protocol: (items, "No configs found for this protocol.") for protocol, items in configs.items()}
+        lists.update({op: (items, f"No configs found for {op}.") for op, items in operator_configs.items()})
+        lists["proxies"] = (proxies, "No proxies found.")
+        self.files = {}
+        for name, (items, placeholder) in lists.items():
+            self.files[f"/{name}.txt"] = render_subscription_body(items, placeholder)
+            self.files[f"/{name}_base64.txt"] = render_subscription_body(items, placeholder, "base64")
+
+        # None stands for any protocol or operator; lists keep their latency ranking
+        self.index = {(None, None): [config for items in configs.values() for config in items]}
+        for protocol, items in configs.items():
+            self.index[(protocol.lower(), None)] = items
+        for op, items in operator_configs.items():
+            self.index[(None, op.lower())] = items
+            for config in items:
+                self.index.setdefault((config_protocol(config), op.lower()), []).append(config)
+        self.protocols = {protocol.lower() for protocol in configs}
+        self.operators = {op.lower() for op in operator_configs}
+        self.queries = OrderedDict()
+        self.created_at = time.time()
+
+    def query(self, params):
+        protocol = params.get("protocol", "").lower() or None
+        operator = params.get("operator", "").lower() or None
+        output_format = params.get("format", "plain").lower()
+        if protocol is not None and protocol not in self.protocols:
+            raise KeyError(f"unknown protocol {protocol}")
+        if operator is not None and operator not in self.operators:
+            raise KeyError(f"unknown operator {operator}")
+        if output_format not in ("plain", "base64"):
+            raise ValueError(f"unknown format {output_format}")
+        limit = params.get("limit")
+        if limit is not None:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError("limit must be positive")
+
+        items = self.index.get((protocol, operator), [])
+        if limit is not None and limit >= len(items):
+            limit = None
+        key = (protocol, operator, limit, output_format)
+        body = self.queries.get(key)
+        if body is None:
+            body = render_subscription_body(items[:limit] if limit else items, "No configs found.", output_format)
+            self.queries[key] = body
+            if len(self.queries) > SERVER_QUERY_CACHE_SIZE:
+                self.queries.popitem(last=False)
+        else:
+            self.queries.move_to_end(key)
+        return body
+
+subscription_snapshot = None
+
+def publish_subscription_snapshot(configs, operator_configs, proxies):
+    global subscription_snapshot
+    with run_metrics.timed("snapshot"):
+        snapshot = SubscriptionSnapshot(configs, operator_configs, proxies)
+    # Handlers read the global once per request, so a request never sees a half-built snapshot
+    subscription_snapshot = snapshot
+    logger.info(f"Published subscription snapshot with {len(snapshot.files)} files")
+
+def accepts_gzip(value):
+    for coding in (value or "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            quality = params.strip().lower()
+            try:
+                return not (quality.startswith("q=") and float(quality[2:]) == 0)
+            except ValueError:
+                return True
+    return False
+
+def etag_matches(value, etag):
+    if not value:
+        return False
+    if value.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return any(tag.strip().removeprefix("W/") == etag for tag in value.split(","))
+
+def subscription_response(snapshot, method, target, headers):
+    if method not in ("GET", "HEAD"):
+        return 405, [("Allow", "GET, HEAD")], b""
+    if snapshot is None:
+        return 503, [("Retry-After", "30")], b"Collection has not finished yet\n"
+
+    parts = urlsplit(target)
+    if parts.path == "/sub":
+        try:
+            body = snapshot.query(dict(parse_qsl(parts.query)))
+        except KeyError as e:
+            return 404, [], f"{e.args[0]}\n".encode("utf-8")
+        except ValueError as e:
+            return 400, [], f"{str(e)}\n".encode("utf-8")
+    else:
+        body = snapshot.files.get(parts.path)
+        if body is None:
+            return 404, [], b"Not found\n"
+
+    use_gzip = accepts_gzip(headers.get("accept-encoding"))
+    etag = body.gzip_etag if use_gzip else body.etag
+    response_headers = [("ETag", etag), ("Vary", "Accept-Encoding"), ("Cache-Control", "no-cache")]
+    if etag_matches(headers.get("if-none-match"), etag):
+        return 304, response_headers, b""
+    response_headers.append(("Content-Type", "text/plain; charset=utf-8"))
+    if use_gzip:
+        response_headers.append(("Content-Encoding", "gzip"))
+    return 200, response_headers, body.gzip_data if use_gzip else body.data
+
+async def handle_subscription_client(reader, writer):
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), SERVER_IDLE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                break
+
+            lines = head.decode("latin-1").split("\r\n")
+            request_line = lines[0].split(" ")
+            headers = {}
+            for line in lines[1:]:
+                name, separator, value = line.partition(":")
+                if separator:
+                    headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) == 3:
+                method, target, version = request_line
+                status, response_headers, body = subscription_response(subscription_snapshot, method, target, headers)
+            else:
+                method, version = "GET", "HTTP/1.0"
+                status, response_headers, body = 400, [], b"Malformed request line\n"
+
+            connection = headers.get("connection", "").lower()
+            # Request bodies are never read, so a request that has one ends the connection
+            keep_alive = (
+                status != 400 and headers.get("content-length", "0") == "0" and "transfer-encoding" not in headers
+                and (connection == "keep-alive" if version == "HTTP/1.0" else connection != "close")
+            )
+            response_headers.append(("Content-Length", str(len(body))))
+            response_headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+            head_lines = [f"HTTP/1.1 {status} {HTTP_REASONS[status]}"] + [f"{name}: {value}" for name, value in response_headers]
+            response = ("\r\n".join(head_lines) + "\r\n\r\n").encode("latin-1")
+            writer.write(response if method == "HEAD" or status == 304 else response + body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_subscription_server(host=SERVER_HOST, port=SERVER_PORT):
+    server = await asyncio.start_server(handle_subscription_client, host, port)
+    for sock in server.sockets:
+        logger.info(f"Subscription server listening on {sock.getsockname()}")
+    print(f"🌐 Serving subscriptions on {host}:{port}")
+    return server
+
+async def publish_collection(collection, channels, channel_cursors, offline=False):
+    if CONFIG_STORE_ENABLED and not offline:
+        # Output lists come from the store, so retention is CONFIG_STORE_TTL rather than the fetch window
+        try:
+            with run_metrics.timed("store"):
+                flush_config_store()
+                store_configs = {protocol: query_config_store("protocol", protocol) for protocol in collection["configs"]}
+                store_operator_configs = defaultdict(list, {
+                    op: query_config_store("operator", op) for op in query_config_store_operators()
+                })
+            collection["configs"] = store_configs
+            collection["operator_configs"] = store_operator_configs
+        except sqlite3.Error as e:
+            logger.error(f"Config store {CONFIG_STORE_FILE} is unavailable, using the fetch window: {str(e)}")
+    all_configs = collection["configs"]
+    all_operator_configs = collection["operator_configs"]
+
+    # Lists are already unique: the aggregator dedups on insert and the store is keyed by fingerprint
+    print("\n" + "=" * 60)
+    for protocol in all_configs:
+        print(f"📊 Found {len(all_configs[protocol])} unique {protocol.upper()} configs")
+        logger.info(f"Found {len(all_configs[protocol])} unique {protocol} configs")
+    for op in all_operator_configs:
+        print(f"📊 Found {len(all_operator_configs[op])} configs for {op}")
+        logger.info(f"Found {len(all_operator_configs[op])} unique configs for operator {op}")
+
+    print(f"📊 Found {len(collection['proxies'])} unique proxies")
+    print(f"📊 Found {len(collection['npvt_files'])} downloaded NPVT files")
+    print("=" * 60 + "\n")
+
+    # Items collected before this run reuse their cached probe and DNS results
+    known = set()
+    if not offline:
+        known = known_items(dict.fromkeys(config for configs in all_configs.values() for config in configs))
+        known.update(known_items(collection["proxies"]))
+        run_new_items.clear()
+
+    if PROBE_ENABLED and not offline:
+        probe_cache = load_probe_cache()
+        # Timelines keep raw links, so they are probed too; endpoints are only connected once
+        probe_candidates = dict.fromkeys(config for configs in all_configs.values() for config in configs)
+        probe_candidates.update(dict.fromkeys(config for configs in all_operator_configs.values() for config in configs))
+        probe_candidates.update(dict.fromkeys(item.config for items in collection["recent_configs"].values() for item in items))
+        with run_metrics.timed("probe"):
+            config_latencies = await probe_configs(probe_candidates, probe_cache, known)
+        reachable_count = sum(1 for latency in config_latencies.values() if latency is not None)
+        print(f"📶 {reachable_count}/{len(config_latencies)} config links reachable")
+        logger.info(f"Probed {len(config_latencies)} config links, {reachable_count} reachable")
+
+        proxy_candidates = dict.fromkeys(collection["proxies"])
+        proxy_candidates.update(dict.fromkeys(item.proxy for items in collection["recent_proxies"].values() for item in items))
+        with run_metrics.timed("probe"):
+            proxy_latencies = await probe_proxies(proxy_candidates, probe_cache, known)
+        live_count = sum(1 for latency in proxy_latencies.values() if latency is not None)
+        print(f"📶 {live_count}/{len(proxy_latencies)} proxies reachable")
+        logger.info(f"Probed {len(proxy_latencies)} proxies, {live_count} reachable")
+        save_probe_cache(probe_cache, known_item_ttl(PROBE_CACHE_TTL))
+        collection["config_latencies"] = config_latencies
+        collection["proxy_latencies"] = proxy_latencies
+        collection["proxies"] = rank_configs_by_latency(collection["proxies"], proxy_latencies, PROXY_DROP_UNREACHABLE)
+
+        for protocol in all_configs:
+            all_configs[protocol] = rank_configs_by_latency(all_configs[protocol], config_latencies)
+        for op in all_operator_configs:
+            all_operator_configs[op] = rank_configs_by_latency(all_operator_configs[op], config_latencies)
+
+    if not offline:
+        readers = open_geoip_readers() if GEOIP_ENABLED else {}
+        if readers:
+            with run_metrics.timed("geo"):
+                country_configs, asn_configs = await enrich_configs_with_geo(all_configs, known)
+            print(f"🌍 Sorted configs into {len(country_configs)} countries and {len(asn_configs)} ASNs")
+        # Each shard directory follows its own database, even when enrichment placed nothing
+        if "country" in readers:
+            save_config_shards(GEO_DIR, country_configs)
+        else:
+            clear_config_shards(GEO_DIR)
+        if "asn" in readers:
+            save_config_shards(ASN_DIR, asn_configs)
+        else:
+            clear_config_shards(ASN_DIR)
+
+    for protocol in all_configs:
+        save_configs(all_configs[protocol], protocol)
+    save_operator_configs(all_operator_configs)
+    save_proxies(collection["proxies"])
+    save_invalid_channels(collection["invalid_channels"])
+    save_channel_stats(collection["channel_stats"])
+    if channel_cursors is not None:
+        save_channel_cursors({str(ch): channel_cursors[str(ch)] for ch in channels if str(ch) in channel_cursors})
+    # Only the daemon serves snapshots, a one-shot run would build one nobody reads
+    if SERVER_PORT and DAEMON_MODE:
+        publish_subscription_snapshot(all_configs, all_operator_configs, collection["proxies"])
+
+async def post_collection(client, collection):
+    with run_metrics.timed("post"):
+        await post_config_and_proxies_to_channel(
+            client,
+            collection["channel_stats"],
+            collection["valid_channels"],
+            collection["recent_configs"],
+            collection["recent_npvt"],
+            collection["recent_proxies"],
+            collection["config_latencies"],
+            collection["proxy_latencies"]
+        )
+
+def save_collector_state(channels, collection):
+    flush_message_archive()
+    save_seen_index()
+    collect_npvt_garbage()
+    save_npvt_index()
+    save_entity_cache()
+    save_output_manifest()
+
+async def record_daemon_message(client, channel, message, channel_cursors, npvt_queue=None):
+    if not message.date:
+        return False
+
+    with run_metrics.timed("extract", channel):
+        extraction = extract_message(message)
+        record = extract_message_record(message, channel, extraction)
+    archive_message(message, channel)
+    if extraction["npvt_file_name"]:
+        if npvt_queue is None:
+            record["npvt"] = await download_npvt_from_message(
+                client, message, channel, extraction["npvt_file_name"], extraction["npvt_password"], NPVT_DOWNLOAD_TIMEOUT
+            )
+        else:
+            # The download workers bound concurrency and apply NPVT_DOWNLOAD_TIMEOUT
+            future = asyncio.get_running_loop().create_future()
+            await npvt_queue.put((message, channel, extraction["npvt_file_name"], extraction["npvt_password"], future))
+            record["npvt"] = await future
+
+    cursor = channel_cursors.setdefault(str(channel), {"last_message_id": 0, "last_message_date": None, "recent_messages": []})
+    if message.id > (cursor.get("last_message_id") or 0):
+        cursor["last_message_id"] = message.id
+        cursor["last_message_date"] = message.date.isoformat()
+    if not (record["configs"] or record["proxies"] or record["npvt"]):
+        return False
+    mark_records_seen(channel, [record])
+    recent_messages = cursor.setdefault("recent_messages", [])
+    recent_messages.insert(0, record)
+    del recent_messages[CURSOR_MAX_RECORDS:]
+    queue_config_sightings(channel, [record])
+    return True
+
+def rebuild_channel_result(channel, channel_cursors):
+    min_date = datetime.now().date() - timedelta(days=1)
+    cursor = channel_cursors.get(str(channel)) or {}
+    recent_records = [
+        record for record in cursor.get("recent_messages", [])
+        if datetime.fromisoformat(record["date"]).date() >= min_date
+    ]
+    if cursor:
+        cursor["recent_messages"] = recent_records
+    return collect_channel_records(channel, recent_records) + (True,)
+
+def skipped_channel_result(channel, channel_cursors, channel_history):
+    entry = channel_history.get(str(channel), {})
+    if entry.get("consecutive_failures"):
+        # Failing and quarantined channels stay listed but are not offered for posting
+        return collect_channel_records(channel, []) + (False,)
+    return rebuild_channel_result(channel, channel_cursors)
+
+async def flush_daemon_state(channels, channel_cursors, daemon_state):
+    # Channels that failed at startup replay that failure; the rest are rebuilt from their cursors
+    failures = daemon_state["collection"]["failures"]
+    with run_metrics.timed("flush"):
+        aggregator = ResultAggregator(channels)
+        for channel in channels:
+            if channel in failures:
+                aggregator.add(channel, failures[channel])
+            else:
+                aggregator.add(channel, rebuild_channel_result(channel, channel_cursors))
+        collection = aggregator.collection()
+        await publish_collection(collection, channels, channel_cursors)
+    flush_message_archive()
+    save_seen_index()
+    # A long-running daemon never reaches save_collector_state, so the NPVT cache is bounded here
+    collect_npvt_garbage()
+    save_npvt_index()
+    save_output_manifest()
+    daemon_state["collection"] = collection
+    logger.info("Daemon flushed outputs")
+    print("💾 Daemon flushed outputs")
+
+async def daemon_flush_loop(channels, channel_cursors, daemon_state):
+    dirty = daemon_state["dirty"]
+    while True:
+        await dirty.wait()
+        first_change = time.monotonic()
+        # Debounce bursts: flush once the channels go quiet, or after the max delay at the latest
+        while True:
+            dirty.clear()
+            remaining = DAEMON_FLUSH_MAX_DELAY - (time.monotonic() - first_change)
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(dirty.wait(), min(DAEMON_FLUSH_DELAY, remaining))
+            except asyncio.TimeoutError:
+                break
+        try:
+            run_metrics.reset()
+            await flush_daemon_state(channels, channel_cursors, daemon_state)
+            save_run_metrics(run_metrics)
+        except Exception as e:
+            logger.error(f"Daemon flush failed: {str(e)}")
+            print(f"❌ Daemon flush failed: {str(e)}")
+
+async def daemon_post_loop(client, daemon_state):
+    while True:
+        await asyncio.sleep(DAEMON_POST_INTERVAL)
+        try:
+            await post_collection(client, daemon_state["collection"])
+        except Exception as e:
+            logger.error(f"Daemon post failed: {str(e)}")
+            print(f"❌ Daemon post failed: {str(e)}")
+
+async def run_daemon(client, channels, channel_cursors, collection):
+    channel_by_peer = {}
+    for channel in collection["valid_channels"]:
+        try:
+            entity = await resolve_channel_target(client, channel)
+            channel_by_peer[utils.get_peer_id(entity)] = channel
+        except Exception as e:
+            logger.error(f"Daemon could not subscribe to {channel}: {str(e)}")
+            print(f"❌ [{channel}] Could not subscribe: {str(e)}")
+    if not channel_by_peer:
+        logger.error("Daemon has no channels to listen to")
+        print("❌ No channels to listen to, leaving daemon mode")
+        return
+
+    daemon_state = {
+        "collection": collection,
+        "dirty": asyncio.Event()
+    }
+    npvt_queue = asyncio.Queue(maxsize=max(1, NPVT_QUEUE_SIZE))
+
+    async def on_new_message(event):
+        channel = channel_by_peer.get(event.chat_id)
+        if channel is None:
+            return
+        try:
+            if await record_daemon_message(client, channel, event.message, channel_cursors, npvt_queue):
+                daemon_state["dirty"].set()
+        except Exception as e:
+            logger.error(f"[{channel}] Failed to process message {event.message.id}: {str(e)}")
+
+    server = None
+    if SERVER_PORT:
+        try:
+            server = await start_subscription_server()
+        except OSError as e:
+            logger.error(f"Could not start subscription server on {SERVER_HOST}:{SERVER_PORT}: {str(e)}")
+            print(f"❌ Could not start subscription server: {str(e)}")
+
+    client.add_event_handler(on_new_message, events.NewMessage(chats=list(channel_by_peer)))
+    tasks = [
+        asyncio.create_task(daemon_flush_loop(channels, channel_cursors, daemon_state)),
+        asyncio.create_task(daemon_post_loop(client, daemon_state))
+    ] + [
+        asyncio.create_task(npvt_download_worker(client, npvt_queue))
+        for _ in range(max(1, NPVT_DOWNLOAD_WORKERS))
+    ]
+    logger.info(f"Daemon listening to {len(channel_by_peer)} channels")
+    print(f"👂 Listening to {len(channel_by_peer)} channels for new messages...")
+    try:
+        await client.run_until_disconnected()
+    finally:
+        client.remove_event_handler(on_new_message)
+        if server is not None:
+            server.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if daemon_state["dirty"].is_set():
+            await flush_daemon_state(channels, channel_cursors, daemon_state)
+        else:
+            save_channel_cursors({str(ch): channel_cursors[str(ch)] for ch in channels if str(ch) in channel_cursors})
+        save_entity_cache()
+
+def use_replay_outputs(directory=REPLAY_OUTPUT_DIR):
+    # A replay writes its lists, stats and manifest to a scratch directory, never over the live outputs
+    global OUTPUT_DIR, GEO_DIR, ASN_DIR, STATS_FILE, INVALID_CHANNELS_FILE, OUTPUT_MANIFEST_FILE, output_manifest
+    OUTPUT_DIR = os.path.join(directory, "Config")
+    GEO_DIR = os.path.join(OUTPUT_DIR, "geo")
+    ASN_DIR = os.path.join(OUTPUT_DIR, "asn")
+    STATS_FILE = os.path.join(directory, "channel_stats.json")
+    INVALID_CHANNELS_FILE = os.path.join(directory, "invalid_channels.txt")
+    OUTPUT_MANIFEST_FILE = os.path.join(directory, "output_manifest.json")
+    output_manifest = None
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+async def replay_archive(output_dir=REPLAY_OUTPUT_DIR):
+    logger.info("Starting offline replay of the message archive")
+    print("🔁 Replaying archived messages offline...\n")
+    run_metrics.reset()
+    started = time.perf_counter()
+
+    days = list_message_archive_days()
+    if not days:
+        print(f"❌ No archived messages found in {MESSAGE_ARCHIVE_DIR}")
+        return
+    use_replay_outputs(output_dir)
+    with run_metrics.timed("replay_load"):
+        # Only the files inside the replay window are read
+        entries = load_message_archive(days[-1] - timedelta(days=1))
+    if not entries:
+        print(f"❌ No archived messages found in {MESSAGE_ARCHIVE_DIR}")
+        return
+
+    # The window is anchored at the newest archived message, so a replay is reproducible
+    latest_date = max(datetime.fromisoformat(entry["date"]) for entry in entries)
+    min_date = latest_date.date() - timedelta(days=1)
+    archived_channels = dict.fromkeys(entry["channel"] for entry in entries)
+    channels = [ch for ch in load_channels() if str(ch) in archived_channels]
+    channels += [ch for ch in archived_channels if ch not in {str(c) for c in channels}]
+
+    records_by_channel = defaultdict(list)
+    entries.sort(key=lambda entry: (entry["date"], entry["id"]), reverse=True)
+    for entry in entries:
+        if datetime.fromisoformat(entry["date"]).date() < min_date:
+            continue
+        channel = entry["channel"]
+        message = archived_entry_to_message(entry)
+        with run_metrics.timed("extract", channel):
+            extraction = extract_message(message)
+            record = extract_message_record(message, channel, extraction)
+        if extraction["npvt_file_name"]:
+            record["npvt"] = await download_npvt_from_message(
+                None, message, channel, extraction["npvt_file_name"], extraction["npvt_password"]
+            )
+        records_by_channel[channel].append(record)
+    replayed_count = sum(len(records) for records in records_by_channel.values())
+
+    with run_metrics.timed("publish"):
+        aggregator = ResultAggregator(channels)
+        for channel in channels:
+            aggregator.add(channel, collect_channel_records(channel, records_by_channel.pop(str(channel), [])) + (True,))
+        collection = aggregator.collection()
+        # Store, probing and GeoIP are skipped so a replay only depends on the archive
+        await publish_collection(collection, channels, None, offline=True)
+    save_npvt_index()
+    save_output_manifest()
+
+    elapsed = time.perf_counter() - started
+    for stage, values in run_metrics.summary()["stages"].items():
+        print(f"⏱️  {stage}: {values['total_seconds']:.3f}s over {values['count']} calls")
+    logger.info(f"Replayed {replayed_count} of {len(entries)} archived messages from {len(channels)} channels in {elapsed:.3f}s")
+    print(f"✅ Replayed {replayed_count} of {len(entries)} archived messages from {len(channels)} channels in {elapsed:.2f}s")
+    print(f"📁 Replay outputs written to {output_dir}")
 
 async def main():
+    if REPLAY_MODE:
+        await replay_archive()
+        return
+
     logger.info("Starting config+proxy collection process")
     print("🚀 Starting config+proxy collection process...\n")
-    invalid_channels = []
-    channel_stats = {}
 
-    if not SESSION_STRING:
+    credentials = load_account_credentials()
+    if not credentials:
         logger.error("No session string provided.")
         print("Please set TELEGRAM_SESSION_STRING in environment variables.")
         return
-    if not API_ID or not API_HASH:
+    if not all(api_id and api_hash for _, api_id, api_hash in credentials):
         logger.error("API ID or API Hash not provided.")
         print("Please set TELEGRAM_API_ID and TELEGRAM_API_HASH in environment variables.")
         return
 
     try:
-        api_id = int(API_ID)
+        credentials = [(session, int(api_id), api_hash) for session, api_id, api_hash in credentials]
     except ValueError:
         logger.error("Invalid TELEGRAM_API_ID format. It must be a number.")
         print("Invalid TELEGRAM_API_ID format. It must be a number.")
         return
 
+    run_metrics.reset()
     TELEGRAM_CHANNELS = load_channels()
-    session = StringSession(SESSION_STRING)
+    channel_cursors = load_channel_cursors()
+    channel_history = load_channel_history()
+    open_seen_index()
 
     try:
-        async with TelegramClient(session, api_id, API_HASH) as client:
-            if not await client.is_user_authorized():
-                logger.error("Invalid session string.")
-                print("Invalid session string. Generate a new one using generate_session.py.")
+        async with contextlib.AsyncExitStack() as stack:
+            clients = []
+            for index, (session, api_id, api_hash) in enumerate(credentials):
+                # Flood waits are handled by the request schedulers instead of Telethon's global auto-sleep
+                pooled_client = await stack.enter_async_context(
+                    TelegramClient(StringSession(session), api_id, api_hash, flood_sleep_threshold=0)
+                )
+                if not await pooled_client.is_user_authorized():
+                    logger.error(f"Invalid session string for account {index + 1}.")
+                    print(f"Invalid session string for account {index + 1}. Generate a new one using generate_session.py.")
+                    continue
+                if len(credentials) > 1:
+                    pooled_client.account_label = f"acct-{hashlib.blake2b(session.encode('utf-8'), digest_size=4).hexdigest()}"
+                    if clients:
+                        pooled_client.scheduler = RequestScheduler(
+                            TELEGRAM_REQUEST_RATE,
+                            TELEGRAM_REQUEST_BURST,
+                            min_intervals={"send": POST_INTERVAL}
+                        )
+                clients.append(pooled_client)
+            if not clients:
                 return
+            # The first authorized account also posts, listens in daemon mode and runs discovery
+            client = clients[0]
+            if len(clients) > 1:
+                print(f"👥 Fetching with {len(clients)} Telegram accounts")
 
-            all_configs = {"vless": [], "vmess": [], "shadowsocks": [], "trojan": []}
-            all_operator_configs = defaultdict(list)
-            all_proxies = []
-            all_npvt_files = []
-            channel_recent_configs = {}
-            channel_recent_npvt = {}
-            channel_recent_proxies = {}
-            valid_channels = []
+            due_channels = select_due_channels(TELEGRAM_CHANNELS, channel_history)
+            print(f"🗓️  {len(due_channels)}/{len(TELEGRAM_CHANNELS)} channels due for polling")
+            logger.info(f"{len(due_channels)} of {len(TELEGRAM_CHANNELS)} channels are due for polling")
 
+            aggregator = ResultAggregator(TELEGRAM_CHANNELS)
+            due_set = set(due_channels)
             for channel in TELEGRAM_CHANNELS:
-                logger.info(f"Fetching configs/proxies from {channel}...")
-                print(f"\n📡 Fetching from {channel}...")
+                if channel not in due_set:
+                    aggregator.add(channel, skipped_channel_result(channel, channel_cursors, channel_history))
+            with run_metrics.timed("fetch"):
+                await fetch_all_channels_sharded(clients, due_channels, aggregator, channel_cursors, channel_history)
+
+            collection = aggregator.collection()
+            await publish_collection(collection, TELEGRAM_CHANNELS, channel_cursors)
+            await post_collection(client, collection)
+            save_collector_state(TELEGRAM_CHANNELS, collection)
+            save_channel_history({str(ch): channel_history[str(ch)] for ch in TELEGRAM_CHANNELS if str(ch) in channel_history})
+            if DISCOVERY_ENABLED:
                 try:
-                    channel_configs, channel_config_timeline, channel_operator_configs, channel_proxies, channel_npvt_files, channel_proxy_timeline, is_valid = await fetch_configs_and_proxies_from_channel(client, channel)
-                    if not is_valid:
-                        print(f"⚠️  [{channel}] Invalid or inaccessible")
-                        invalid_channels.append(channel)
-                        channel_stats[channel] = {
-                            "vless_count": 0,
-                            "vmess_count": 0,
-                            "shadowsocks_count": 0,
-                            "trojan_count": 0,
-                            "proxy_count": 0,
-                            "total_configs": 0,
-                            "score": 0,
-                            "error": "Channel does not exist or is inaccessible"
-                        }
-                        continue
-
-                    valid_channels.append(channel)
-                    total_configs = sum(len(configs) for configs in channel_configs.values())
-                    proxy_count = len(channel_proxies)
-                    score = total_configs + proxy_count
-                    print(f"   └─ vless: {len(channel_configs['vless'])} | vmess: {len(channel_configs['vmess'])} | ss: {len(channel_configs['shadowsocks'])} | trojan: {len(channel_configs['trojan'])} | proxies: {proxy_count} | npvt: {len(channel_npvt_files)}")
-
-                    channel_stats[channel] = {
-                        "vless_count": len(channel_configs["vless"]),
-                        "vmess_count": len(channel_configs["vmess"]),
-                        "shadowsocks_count": len(channel_configs["shadowsocks"]),
-                        "trojan_count": len(channel_configs["trojan"]),
-                        "proxy_count": proxy_count,
-                        "total_configs": total_configs,
-                        "score": score
-                    }
-
-                    for protocol in all_configs:
-                        all_configs[protocol].extend(channel_configs[protocol])
-                    for op in channel_operator_configs:
-                        all_operator_configs[op].extend(channel_operator_configs[op])
-
-                    all_proxies.extend(channel_proxies)
-                    all_npvt_files.extend([item["file_path"] for item in channel_npvt_files])
-                    channel_recent_configs[channel] = channel_config_timeline
-                    channel_recent_npvt[channel] = channel_npvt_files
-                    channel_recent_proxies[channel] = channel_proxy_timeline
+                    with run_metrics.timed("discovery"):
+                        await discover_channels(client, TELEGRAM_CHANNELS)
                 except Exception as e:
-                    print(f"❌ [{channel}] Exception: {str(e)}")
-                    invalid_channels.append(channel)
-                    channel_stats[channel] = {
-                        "vless_count": 0,
-                        "vmess_count": 0,
-                        "shadowsocks_count": 0,
-                        "trojan_count": 0,
-                        "proxy_count": 0,
-                        "total_configs": 0,
-                        "score": 0,
-                        "error": str(e)
-                    }
-                    logger.error(f"Channel {channel} is invalid: {str(e)}")
-
-            print("\n" + "=" * 60)
-            for protocol in all_configs:
-                all_configs[protocol] = list(set(all_configs[protocol]))
-                print(f"📊 Found {len(all_configs[protocol])} unique {protocol.upper()} configs")
-                logger.info(f"Found {len(all_configs[protocol])} unique {protocol} configs")
-            for op in all_operator_configs:
-                all_operator_configs[op] = list(set(all_operator_configs[op]))
-                print(f"📊 Found {len(all_operator_configs[op])} configs for {op}")
-                logger.info(f"Found {len(all_operator_configs[op])} unique configs for operator {op}")
-
-            all_proxies = list(dict.fromkeys(all_proxies))
-            all_npvt_files = list(dict.fromkeys(all_npvt_files))
-            print(f"📊 Found {len(all_proxies)} unique proxies")
-            print(f"📊 Found {len(all_npvt_files)} downloaded NPVT files")
-            print("=" * 60 + "\n")
-
-            for protocol in all_configs:
-                save_configs(all_configs[protocol], protocol)
-            save_operator_configs(all_operator_configs)
-            save_proxies(all_proxies)
-            save_invalid_channels(invalid_channels)
-            save_channel_stats(channel_stats)
-
-            await post_config_and_proxies_to_channel(
-                client,
-                channel_stats,
-                valid_channels,
-                channel_recent_configs,
-                channel_recent_npvt,
-                channel_recent_proxies
-            )
-            update_channels(valid_channels)
+                    logger.error(f"Channel discovery failed: {str(e)}")
+            save_run_metrics(run_metrics)
+
+            if DAEMON_MODE:
+                await run_daemon(client, TELEGRAM_CHANNELS, channel_cursors, collection)
+            elif SERVER_PORT:
+                logger.warning("SERVER_PORT is set but the subscription server only runs in daemon mode")
 
     except Exception as e:
         logger.error(f"Error in main loop: {str(e)}")
         print(f"Error in main loop: {str(e)}")
+        save_run_metrics(run_metrics)
         return
 
     logger.info("Config+proxy collection process completed")